@@ -0,0 +1,377 @@
+"""
+Benchmarks for the Doodler's load, render, paint and save paths.
+
+Drives a real Doodler window with synthetic .npy images of several sizes,
+dtypes and channel layouts, and simulated brush strokes, without any user
+input. Each case runs in its own process so its peak memory is its own.
+Results are written as JSON, so runs on different releases can be compared:
+
+    python benchmarks/bench_doodler.py --json before.json
+    python benchmarks/bench_doodler.py --sizes 512 16384 --dtypes uint8 --json after.json
+    python benchmarks/bench_doodler.py --compare before.json after.json
+
+Needs a display; on a server, run it under xvfb-run.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_SIZES = (512, 2048, 8192)
+DEFAULT_DTYPES = ("uint8", "uint16", "float32")
+# gray: (H, W), rgb: (H, W, 3), chw: (3, H, W)
+LAYOUTS = ("gray", "rgb", "chw")
+DEFAULT_LAYOUTS = ("gray", "rgb")
+# Repeats of the load and render measurements
+REPEATS = 5
+ZOOMS = (0.5, 1.0, 2.0)
+# Simulated strokes per case, and motion events per stroke
+STROKES = 20
+STROKE_EVENTS = 60
+# Motion events that arrive within one frame (about 60 fps at 240 Hz pointer events)
+EVENTS_PER_FRAME = 4
+# Slower by more than this ratio is flagged by --compare
+REGRESSION_RATIO = 1.2
+
+
+class _Event:
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+
+def make_image(path, size, dtype, layout, seed=0):
+    """Write a size x size test image: smooth structure plus noise, written in bands."""
+    rng = np.random.default_rng(seed)
+    shape = {"gray": (size, size), "rgb": (size, size, 3), "chw": (3, size, size)}[layout]
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    xx = np.arange(size, dtype=np.float32)[None, :]
+    band = max(1, (1 << 22) // size)
+    for top in range(0, size, band):
+        yy = np.arange(top, min(size, top + band), dtype=np.float32)[:, None]
+        values = np.sin(xx / 37.0) + np.cos(yy / 53.0)
+        values = values + rng.normal(0.0, 0.1, values.shape).astype(np.float32)
+        if dtype == "uint8":
+            values = (values + 2.2) * (255 / 4.4)
+        elif dtype == "uint16":
+            values = (values + 2.2) * (4095 / 4.4)  # 12-bit camera data
+        values = values.astype(dtype)
+        if layout == "gray":
+            out[top:top + len(yy)] = values
+        elif layout == "rgb":
+            out[top:top + len(yy)] = values[:, :, None]
+        else:
+            out[:, top:top + len(yy)] = values[None]
+    out.flush()
+    del out
+
+
+def stroke_points(rng, width, height, events=STROKE_EVENTS):
+    """Canvas positions of one stroke: a random walk inside the visible window."""
+    x, y = rng.uniform(0, width), rng.uniform(0, height)
+    points = []
+    for _ in range(events + 1):
+        x = float(np.clip(x + rng.normal(0, 8), 0, width - 1))
+        y = float(np.clip(y + rng.normal(0, 8), 0, height - 1))
+        points.append((x, y))
+    return points
+
+
+def summarize(samples):
+    """Latency statistics in milliseconds for a list of durations in seconds."""
+    ms = np.asarray(samples, dtype=np.float64) * 1000.0
+    if not len(ms):
+        return None
+    return {
+        "n": int(len(ms)),
+        "mean": round(float(ms.mean()), 3),
+        "p50": round(float(np.percentile(ms, 50)), 3),
+        "p95": round(float(np.percentile(ms, 95)), 3),
+        "p99": round(float(np.percentile(ms, 99)), 3),
+        "max": round(float(ms.max()), 3),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, or None where unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def anon_rss_mb():
+    """
+    Current resident memory that is not backed by files (Linux only). Peak
+    RSS also counts pages of memory-mapped images the kernel has mapped in,
+    which cost nothing to drop.
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _pump(app, done, timeout=600):
+    """Run the Tk event loop until done() is true."""
+    start = time.perf_counter()
+    while not done():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError("the Doodler did not finish in time")
+        app.root.update()
+        time.sleep(0.001)
+
+
+def run_case(folder, name):
+    """Measure one image in a fresh Doodler. Runs in the case's own process."""
+    from pixeldoodler.gui import Doodler
+
+    path = os.path.join(folder, name)
+    timings = {}
+    counters = {}
+    app = Doodler()
+    app.root.update()
+    try:
+        # Open the folder: scan, decode, first render
+        start = time.perf_counter()
+        app.load_folder(folder)
+        _pump(app, lambda: app.image is not None and app.pending_load is None)
+        app.root.update_idletasks()
+        timings["open"] = [time.perf_counter() - start]
+        counters["tiled"] = type(app.image).__name__ == "TiledImage"
+        # Thumbnails are made in the background; don't let them skew what follows
+        _pump(app, lambda: not app.filmstrip.pending and app.folder_index.complete)
+
+        # Decode and pyramid, with the file's cached display range invalidated every time
+        timings["decode"] = []
+        stat = os.stat(path)
+        for i in range(REPEATS):
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + i + 1))
+            start = time.perf_counter()
+            app._prepare_image(path)
+            timings["decode"].append(time.perf_counter() - start)
+
+        # Full redraws at several zoom levels, without and with cached tiles
+        for zoom in ZOOMS:
+            app.update_zoom(zoom)
+            cold, warm = [], []
+            for _ in range(REPEATS):
+                app.tile_cache.clear()
+                start = time.perf_counter()
+                app.display_image()
+                app.root.update_idletasks()
+                cold.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                app.display_image()
+                app.root.update_idletasks()
+                warm.append(time.perf_counter() - start)
+            timings[f"render_cold_{zoom:g}x"] = cold
+            timings[f"render_warm_{zoom:g}x"] = warm
+
+        # Panning across the image at 1x
+        app.update_zoom(1.0)
+        timings["pan"] = []
+        for step in range(1, 21):
+            app.canvas.xview_moveto(step / 40.0)
+            app.canvas.yview_moveto(step / 40.0)
+            start = time.perf_counter()
+            app.render_view()
+            app.root.update_idletasks()
+            timings["pan"].append(time.perf_counter() - start)
+        app.canvas.xview_moveto(0.0)
+        app.canvas.yview_moveto(0.0)
+        app.render_view()
+
+        # Brush strokes: every motion event, one flush per frame, stroke start and end
+        rng = np.random.default_rng(1)
+        width = min(app.canvas.winfo_width(), app.image.width)
+        height = min(app.canvas.winfo_height(), app.image.height)
+        for key in ("stroke_start", "paint_event", "paint_frame", "stroke_end"):
+            timings[key] = []
+        events = 0
+        paint_time = 0.0
+        for _ in range(STROKES):
+            points = stroke_points(rng, width, height)
+            start = time.perf_counter()
+            app.start_stroke(_Event(*points[0]))
+            timings["stroke_start"].append(time.perf_counter() - start)
+            for i, point in enumerate(points[1:], 1):
+                start = time.perf_counter()
+                app.paint(_Event(*point))
+                if i % EVENTS_PER_FRAME == 0:
+                    frame_start = time.perf_counter()
+                    app.flush_paint()
+                    timings["paint_frame"].append(time.perf_counter() - frame_start)
+                elapsed = time.perf_counter() - start
+                timings["paint_event"].append(elapsed)
+                paint_time += elapsed
+                events += 1
+            start = time.perf_counter()
+            app.reset_last_coords(None)
+            timings["stroke_end"].append(time.perf_counter() - start)
+        counters["paint_events_per_s"] = round(events / paint_time, 1) if paint_time else None
+
+        timings["undo"] = []
+        timings["redo"] = []
+        for _ in range(STROKES):
+            start = time.perf_counter()
+            app.undo()
+            timings["undo"].append(time.perf_counter() - start)
+        for _ in range(STROKES):
+            start = time.perf_counter()
+            app.redo()
+            timings["redo"].append(time.perf_counter() - start)
+
+        # Saves: the time the UI is held up, and the time until the file is written
+        timings["save_submit"] = []
+        timings["save_total"] = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            app.save_brush_strokes()
+            timings["save_submit"].append(time.perf_counter() - start)
+            app.flush_saves()
+            timings["save_total"].append(time.perf_counter() - start)
+        counters["anon_rss_mb"] = anon_rss_mb()
+    finally:
+        app.on_close()
+
+    counters["peak_rss_mb"] = peak_rss_mb()
+    metrics = {key: summarize(samples) for key, samples in timings.items()}
+    return {"latency_ms": metrics, **counters}
+
+
+def metadata(args):
+    import PIL
+
+    try:
+        from importlib.metadata import version
+
+        pixeldoodler_version = version("pixeldoodler")
+    except Exception:
+        pixeldoodler_version = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "pixeldoodler": pixeldoodler_version,
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "sizes": args.sizes,
+        "dtypes": args.dtypes,
+        "layouts": args.layouts,
+    }
+
+
+def run_all(args):
+    cases = [
+        {"size": size, "dtype": dtype, "layout": layout}
+        for size in args.sizes for dtype in args.dtypes for layout in args.layouts
+    ]
+    results = {"meta": metadata(args), "cases": []}
+    workdir = tempfile.mkdtemp(prefix="pixeldoodler-bench-")
+    try:
+        for case in cases:
+            folder = os.path.join(workdir, "{size}-{dtype}-{layout}".format(**case))
+            os.makedirs(folder)
+            name = "image.npy"
+            make_image(os.path.join(folder, name), case["size"], case["dtype"], case["layout"])
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run-case", folder, name],
+                capture_output=True, text=True,
+            )
+            shutil.rmtree(folder, ignore_errors=True)
+            if proc.returncode != 0:
+                print(f"{folder}: failed\n{proc.stderr}", file=sys.stderr)
+                results["cases"].append({**case, "error": proc.stderr.strip().splitlines()[-1:]})
+                continue
+            result = {**case, **json.loads(proc.stdout.strip().splitlines()[-1])}
+            results["cases"].append(result)
+            _print_case(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+def _case_name(case):
+    return "{size} {dtype} {layout}".format(**case)
+
+
+def _print_case(result):
+    print(f"{_case_name(result)}: peak {result['peak_rss_mb']} MB ({result['anon_rss_mb']} MB anonymous at the end), "
+          f"{result['paint_events_per_s']} paint events/s{' (tiled)' if result['tiled'] else ''}")
+    for key, stats in result["latency_ms"].items():
+        if stats:
+            print(f"  {key:<18} p50 {stats['p50']:>9.2f} ms   p95 {stats['p95']:>9.2f} ms   max {stats['max']:>9.2f} ms")
+
+
+def compare(base_path, new_path):
+    """Print the p50 ratio new/base of every latency both runs measured."""
+    with open(base_path, encoding="utf-8") as f:
+        base = {_case_name(case): case for case in json.load(f)["cases"] if "error" not in case}
+    with open(new_path, encoding="utf-8") as f:
+        new = {_case_name(case): case for case in json.load(f)["cases"] if "error" not in case}
+    regressions = 0
+    for name in sorted(base.keys() & new.keys()):
+        print(name)
+        old_metrics, new_metrics = base[name]["latency_ms"], new[name]["latency_ms"]
+        for key in old_metrics.keys() & new_metrics.keys():
+            if not old_metrics[key] or not new_metrics[key]:
+                continue
+            before, after = old_metrics[key]["p50"], new_metrics[key]["p50"]
+            ratio = after / before if before else float("inf")
+            flag = "  SLOWER" if ratio > REGRESSION_RATIO else ""
+            regressions += bool(flag)
+            print(f"  {key:<18} {before:>9.2f} -> {after:>9.2f} ms  x{ratio:.2f}{flag}")
+    print(f"{regressions} metric{'s' if regressions != 1 else ''} slower by more than x{REGRESSION_RATIO}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the PixelDoodler GUI code paths.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Image side lengths (default: %(default)s).")
+    parser.add_argument("--dtypes", nargs="+", default=list(DEFAULT_DTYPES),
+                        choices=("uint8", "uint16", "float32"), help="Image dtypes.")
+    parser.add_argument("--layouts", nargs="+", default=list(DEFAULT_LAYOUTS),
+                        choices=LAYOUTS, help="Channel layouts: gray (H, W), rgb (H, W, 3), chw (3, H, W).")
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"),
+                        help="Compare two result files instead of running.")
+    parser.add_argument("--run-case", nargs=2, metavar=("FOLDER", "NAME"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+    if args.run_case:
+        print(json.dumps(run_case(*args.run_case)))
+        return 0
+    return run_all(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
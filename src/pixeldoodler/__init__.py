@@ -1,8 +1,53 @@
-from .gui import Doodler
-
-def main():
+def main(argv=None):
     """Console entry point for pixeldoodler."""
+    import argparse
+    import os
+
+    from .instrument import DEFAULT_TRACE_FILE, TRACE_ENV, tracer
+
+    parser = argparse.ArgumentParser(prog="pixeldoodler", description="Pixel-wise image labelling.")
+    parser.add_argument(
+        "--trace", nargs="?", const=DEFAULT_TRACE_FILE, metavar="FILE",
+        help=f"Time the app's stages and append them to FILE (default: {DEFAULT_TRACE_FILE}). "
+        f"Setting {TRACE_ENV}=FILE does the same.",
+    )
+    parser.add_argument(
+        "--classes", metavar="FILE",
+        help="JSON file listing the classes to label (see the README). "
+        "Defaults to $PIXELDOODLER_CLASSES, then ~/.config/pixeldoodler/classes.json.",
+    )
+    parser.add_argument(
+        "--prelabel", metavar="MODULE:FUNCTION",
+        help="Model that proposes a starting mask for each file: a function taking the image "
+        "as a NumPy array and returning a label map (see the README). "
+        "Setting PIXELDOODLER_PRELABEL does the same.",
+    )
+    args = parser.parse_args(argv)
+    if args.classes:
+        # Read when the masks module is first imported
+        os.environ["PIXELDOODLER_CLASSES"] = args.classes
+    if args.prelabel:
+        # Read by the app, and inherited by its worker processes
+        os.environ["PIXELDOODLER_PRELABEL"] = args.prelabel
+    from .masks import CLASSES_ERROR
+
+    if CLASSES_ERROR:
+        parser.error(CLASSES_ERROR)
+    if args.trace:
+        tracer.start(args.trace)
+
+    from .gui import Doodler
+
     app = Doodler()
     app.root.mainloop()
 
+
+def __getattr__(name):
+    # Imported lazily so the headless tools never need Tk
+    if name == "Doodler":
+        from .gui import Doodler
+        return Doodler
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 __all__ = ["Doodler", "main"]
\ No newline at end of file
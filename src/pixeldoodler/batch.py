@@ -0,0 +1,174 @@
+"""
+Headless batch tools for PixelDoodler folders. Nothing here imports Tk, so
+these run on machines without a display:
+
+    pixeldoodler-batch convert FOLDER --to npy   # *_mask.png -> *_mask.npy
+    pixeldoodler-batch convert FOLDER --to png   # *_mask.npy -> *_mask.png
+    pixeldoodler-batch pack FOLDER               # pre-decode images for fast opening
+    pixeldoodler-batch trace FILE...             # stage timings from --trace files
+"""
+import argparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from .instrument import summarize_traces
+from .masks import CLASSES_ERROR, MASK_SUFFIX, image_to_labels, mask_preview, write_atomic
+from .pack import pack_folder
+
+
+def _convert_png_to_npy(src, dst):
+    with Image.open(src) as image:
+        labels = image_to_labels(image)
+    write_atomic(dst, lambda f: np.save(f, labels))
+
+
+def _convert_npy_to_png(src, dst):
+    labels = np.load(src)
+    if labels.ndim != 2:
+        raise ValueError(f"expected a 2D label map, got shape {labels.shape}")
+    write_atomic(dst, lambda f: mask_preview(labels).save(f, format="PNG"))
+
+
+def convert_one(task):
+    """
+    Convert one mask file. Runs in a worker process and never raises, so
+    one bad file does not stop the batch: returns (source, status, detail)
+    with status one of "converted", "skipped" or "failed".
+    """
+    src, dst, overwrite = task
+    if not overwrite and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return src, "skipped", "up to date"
+    try:
+        if dst.endswith(".npy"):
+            _convert_png_to_npy(src, dst)
+        else:
+            _convert_npy_to_png(src, dst)
+    except Exception as e:
+        return src, "failed", str(e)
+    return src, "converted", dst
+
+
+def find_masks(folder, to):
+    """Yield (source, destination) pairs for every mask in the folder that can be converted."""
+    src_ext, dst_ext = (".png", ".npy") if to == "npy" else (".npy", ".png")
+    with os.scandir(folder) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            base, ext = os.path.splitext(entry.name)
+            if entry.is_file() and ext.lower() == src_ext and base.endswith(MASK_SUFFIX):
+                yield entry.path, os.path.join(folder, base + dst_ext)
+
+
+def convert_folder(folder, to, workers=None, overwrite=False):
+    """
+    Convert all masks in a folder on a pool of worker processes, yielding
+    results as they finish (not in folder order).
+    """
+    tasks = [(src, dst, overwrite) for src, dst in find_masks(folder, to)]
+    if not tasks:
+        return
+    with Pool(workers) as pool:
+        yield from pool.imap_unordered(convert_one, tasks, chunksize=8)
+
+
+def _convert_command(args):
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    for src, status, detail in convert_folder(args.folder, args.to, args.workers, args.overwrite):
+        counts[status] += 1
+        if status == "failed" or args.verbose:
+            print(f"{status}: {src} ({detail})", flush=True)
+    print(
+        f"{counts['converted']} converted, {counts['skipped']} skipped, {counts['failed']} failed"
+    )
+    return 1 if counts["failed"] else 0
+
+
+def _pack_command(args):
+    counts = {"packed": 0, "reused": 0, "skipped": 0, "failed": 0}
+    try:
+        for path, status, detail in pack_folder(args.folder, args.workers):
+            counts[status] += 1
+            if status == "failed" or args.verbose:
+                print(f"{status}: {path}" + (f" ({detail})" if detail else ""), flush=True)
+    except OSError as e:
+        print(f"could not write the pack: {e}", file=sys.stderr)
+        return 1
+    print(
+        f"{counts['packed']} packed, {counts['reused']} unchanged, "
+        f"{counts['skipped']} skipped, {counts['failed']} failed"
+    )
+    return 1 if counts["failed"] else 0
+
+
+def _trace_command(args):
+    summary = summarize_traces(args.files)
+    if args.json:
+        print(json.dumps(summary, indent=1))
+        return 0
+    print(f"{'stage':<16}{'calls':>9}{'sessions':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, stats in summary.items():
+        print(
+            f"{stage:<16}{stats['n']:>9}{stats['sessions']:>10}{stats['p50']:>10.2f}"
+            f"{stats['p95']:>10.2f}{stats['p99']:>10.2f}{stats['max']:>10.2f}"
+        )
+    return 0
+
+
+def main(argv=None):
+    """Console entry point for pixeldoodler-batch."""
+    parser = argparse.ArgumentParser(
+        prog="pixeldoodler-batch", description="Headless batch tools for PixelDoodler folders."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser(
+        "convert", help="Convert *_mask.png colour masks to *_mask.npy label maps or back."
+    )
+    convert.add_argument("folder", help="Folder containing the masks.")
+    convert.add_argument(
+        "--to", choices=("npy", "png"), default="npy", help="Output format (default: npy)."
+    )
+    convert.add_argument(
+        "-j", "--workers", type=int, default=None,
+        help="Number of worker processes (default: one per CPU).",
+    )
+    convert.add_argument(
+        "--overwrite", action="store_true", help="Rewrite outputs that are already up to date."
+    )
+    convert.add_argument("-v", "--verbose", action="store_true", help="Print every file.")
+    convert.set_defaults(func=_convert_command)
+
+    pack = commands.add_parser(
+        "pack",
+        help="Decode a folder's images into one memory-mapped file the app opens them from instantly.",
+    )
+    pack.add_argument("folder", help="Folder containing the images.")
+    pack.add_argument(
+        "-j", "--workers", type=int, default=None,
+        help="Number of worker processes (default: one per CPU).",
+    )
+    pack.add_argument("-v", "--verbose", action="store_true", help="Print every file.")
+    pack.set_defaults(func=_pack_command)
+
+    trace = commands.add_parser(
+        "trace", help="Summarise stage timings from trace files written by pixeldoodler --trace."
+    )
+    trace.add_argument("files", nargs="+", help="Trace files, from any number of sessions and users.")
+    trace.add_argument("--json", action="store_true", help="Print the summary as JSON.")
+    trace.set_defaults(func=_trace_command)
+
+    args = parser.parse_args(argv)
+    if args.command in ("convert", "pack") and not os.path.isdir(args.folder):
+        parser.error(f"not a folder: {args.folder}")
+    if args.command == "convert" and CLASSES_ERROR:
+        # Converting masks needs the class colours
+        parser.error(CLASSES_ERROR)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
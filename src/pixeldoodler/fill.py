@@ -0,0 +1,72 @@
+import numpy as np
+
+
+def _runs(candidates):
+    """
+    Horizontal runs of True pixels, in row-major order, as (rows, starts,
+    ends) arrays with exclusive ends. Found for the whole image at once
+    from the edges of each row.
+    """
+    height, width = candidates.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = candidates
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends
+
+
+def flood_fill(candidates, x, y):
+    """
+    Scanline flood fill: the 4-connected region of True pixels in the 2D
+    boolean array candidates that contains (x, y).
+
+    Returns (left, top, right, bottom, region) where region is a boolean
+    array covering just that bounding box, or None if (x, y) is not a
+    candidate. The search walks whole runs rather than pixels, so large
+    regions cost a few vectorised passes per step of the search.
+    """
+    height, width = candidates.shape
+    if not (0 <= x < width and 0 <= y < height) or not candidates[y, x]:
+        return None
+
+    rows, starts, ends = _runs(candidates)
+    # Sortable keys for run ends and starts, so all neighbour lookups for a
+    # whole frontier of runs are two searchsorted calls
+    stride = width + 1
+    start_keys = rows.astype(np.int64) * stride + starts
+    end_keys = rows.astype(np.int64) * stride + ends
+
+    seed = np.searchsorted(end_keys, np.int64(y) * stride + x, side="right")
+    visited = np.zeros(len(rows), dtype=bool)
+    visited[seed] = True
+    frontier = np.array([seed])
+
+    # Breadth-first over runs: a run in the row above or below is connected
+    # if it overlaps [start, end)
+    while len(frontier):
+        neighbours = []
+        for step in (-1, 1):
+            other_rows = rows[frontier].astype(np.int64) + step
+            ok = (other_rows >= 0) & (other_rows < height)
+            base = other_rows[ok] * stride
+            lo = np.searchsorted(end_keys, base + starts[frontier][ok], side="right")
+            hi = np.searchsorted(start_keys, base + ends[frontier][ok], side="left")
+            counts = np.maximum(hi - lo, 0)
+            offsets = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            neighbours.append(offsets + np.arange(counts.sum()))
+        found = np.unique(np.concatenate(neighbours))
+        frontier = found[~visited[found]]
+        visited[frontier] = True
+
+    rows, starts, ends = rows[visited], starts[visited], ends[visited]
+    left, right = int(starts.min()), int(ends.max())
+    top, bottom = int(rows.min()), int(rows.max()) + 1
+
+    # +1 at each run start and -1 at its end (runs never touch, so no cell
+    # gets both); a running sum along the rows is then 1 exactly inside the runs
+    edges = np.zeros((bottom - top, right - left + 1), dtype=np.int8)
+    edges[rows - top, starts - left] = 1
+    edges[rows - top, ends - left] = -1
+    region = np.cumsum(edges, axis=1, dtype=np.int8)[:, :-1] > 0
+    return left, top, right, bottom, region
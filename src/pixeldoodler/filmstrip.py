@@ -0,0 +1,203 @@
+import os
+import tkinter as tk
+from tkinter import ttk
+from collections import OrderedDict
+
+from PIL import ImageTk
+
+from .thumbnails import THUMB_SIZE, load_thumbnail
+
+# Width and height of one filmstrip cell, thumbnail plus margin
+CELL_SIZE = THUMB_SIZE + 8
+# Thumbnails kept as Tk images (least recently used are dropped)
+PHOTO_CACHE_SIZE = 512
+
+
+class Filmstrip:
+    """
+    Scrollable strip of thumbnails of the folder's images, with their masks
+    drawn over them. Clicking a thumbnail calls on_select(index).
+
+    Only the cells in view exist on the canvas, so folders of any size cost
+    the same to show. Thumbnails come from the on-disk cache in thumbnails.py
+    and are made on the given pool; requests for cells that have scrolled
+    out of view before they started are cancelled.
+    """
+
+    def __init__(self, parent, on_select, pool):
+        self.on_select = on_select
+        self.pool = pool
+        self.folder = ""
+        self.names = []
+        self.current = -1
+
+        self.photos = OrderedDict()  # name -> PhotoImage
+        self.pending = {}  # name -> future
+        self.waiting = []  # (name, future): redo the thumbnail once future (a save) is done
+        self.cells = {}  # index -> (name, canvas item)
+        self.render_pending = False
+        self.polling = False
+
+        self.frame = ttk.Frame(parent)
+        self.canvas = tk.Canvas(
+            self.frame, height=CELL_SIZE, bg="#2a2a2a", highlightthickness=0,
+            xscrollincrement=CELL_SIZE,
+        )
+        self.canvas.pack(side=tk.TOP, fill=tk.X)
+        scrollbar = ttk.Scrollbar(self.frame, orient=tk.HORIZONTAL, command=self._on_scroll)
+        scrollbar.pack(side=tk.TOP, fill=tk.X)
+        self.canvas.configure(xscrollcommand=scrollbar.set)
+
+        self.canvas.bind("<Configure>", lambda event: self.schedule_render())
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<MouseWheel>", self._on_wheel)
+        self.canvas.bind("<Button-4>", lambda event: self._scroll_units(-1))
+        self.canvas.bind("<Button-5>", lambda event: self._scroll_units(1))
+
+    def set_files(self, folder, names):
+        """Show another file list; thumbnails are kept while the folder stays the same."""
+        if folder != self.folder:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending = {}
+            self.waiting = []
+            self.photos.clear()
+            self.folder = folder
+        self.names = names
+        self.canvas.delete("all")
+        self.cells = {}
+        self.canvas.configure(scrollregion=(0, 0, len(names) * CELL_SIZE, CELL_SIZE))
+        self.schedule_render()
+
+    def set_current(self, index):
+        """Highlight the current image and scroll it into view."""
+        self.current = index
+        if 0 <= index < len(self.names):
+            first, last = self._visible_range()
+            if not first <= index < last - 1:
+                total = len(self.names) * CELL_SIZE
+                offset = index * CELL_SIZE - (self.canvas.winfo_width() - CELL_SIZE) / 2
+                self.canvas.xview_moveto(max(0.0, offset / total))
+        self.schedule_render()
+
+    def invalidate(self, name, after=None):
+        """Redo the thumbnail of name, once the future after (e.g. a save of its mask) is done."""
+        self.waiting.append((name, after))
+        self._start_polling()
+
+    # ------------------------------------------------------------------ Drawing
+    def schedule_render(self):
+        if not self.render_pending:
+            self.render_pending = True
+            self.canvas.after_idle(self.render)
+
+    def render(self):
+        """Draw the cells in view, drop the others and queue missing thumbnails."""
+        self.render_pending = False
+        first, last = self._visible_range()
+
+        for index in list(self.cells):
+            name, _ = self.cells[index]
+            if not first <= index < last or index >= len(self.names) or self.names[index] != name:
+                self._drop_cell(index)
+        for name in list(self.pending):
+            if name not in self.names[first:last] and self.pending[name].cancel():
+                del self.pending[name]
+
+        for index in range(first, last):
+            if index not in self.cells:
+                self._draw_cell(index)
+
+        self.canvas.delete("selected")
+        if first <= self.current < last:
+            x = self.current * CELL_SIZE
+            self.canvas.create_rectangle(
+                x + 1, 1, x + CELL_SIZE - 1, CELL_SIZE - 1,
+                outline="#ffffff", width=2, tags="selected",
+            )
+
+    def _visible_range(self):
+        left = self.canvas.canvasx(0)
+        first = max(0, int(left // CELL_SIZE))
+        last = min(len(self.names), int((left + self.canvas.winfo_width()) // CELL_SIZE) + 1)
+        return first, last
+
+    def _draw_cell(self, index):
+        name = self.names[index]
+        x = index * CELL_SIZE + CELL_SIZE // 2
+        photo = self.photos.get(name)
+        if photo is not None:
+            self.photos.move_to_end(name)
+            item = self.canvas.create_image(x, CELL_SIZE // 2, image=photo)
+        else:
+            item = self.canvas.create_rectangle(
+                x - THUMB_SIZE // 2, 4, x + THUMB_SIZE // 2, 4 + THUMB_SIZE,
+                outline="#555555", fill="#333333",
+            )
+            self._request(name)
+        self.cells[index] = (name, item)
+
+    def _drop_cell(self, index):
+        _, item = self.cells.pop(index)
+        self.canvas.delete(item)
+
+    def _redraw(self, name):
+        for index, (cell_name, _) in list(self.cells.items()):
+            if cell_name == name:
+                self._drop_cell(index)
+        self.schedule_render()
+
+    # ------------------------------------------------------------------ Thumbnails
+    def _request(self, name):
+        if name in self.pending:
+            return
+        path = os.path.join(self.folder, name)
+        self.pending[name] = self.pool.submit(load_thumbnail, path)
+        self._start_polling()
+
+    def _start_polling(self):
+        if not self.polling:
+            self.polling = True
+            self.canvas.after(30, self._poll)
+
+    def _poll(self):
+        for name, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[name]
+            if future.cancelled() or future.exception() is not None:
+                continue  # the placeholder stays
+            self.photos[name] = ImageTk.PhotoImage(future.result())
+            while len(self.photos) > PHOTO_CACHE_SIZE:
+                self.photos.popitem(last=False)
+            self._redraw(name)
+
+        still_waiting = []
+        for name, after in self.waiting:
+            if after is not None and not after.done():
+                still_waiting.append((name, after))
+            else:
+                self.photos.pop(name, None)
+                self._redraw(name)
+        self.waiting = still_waiting
+
+        self.polling = bool(self.pending or self.waiting)
+        if self.polling:
+            self.canvas.after(30, self._poll)
+
+    # ------------------------------------------------------------------ Events
+    def _on_scroll(self, *args):
+        self.canvas.xview(*args)
+        self.schedule_render()
+
+    def _scroll_units(self, units):
+        self.canvas.xview_scroll(units, "units")
+        self.schedule_render()
+
+    def _on_wheel(self, event):
+        self._scroll_units(-1 if event.delta > 0 else 1)
+
+    def _on_click(self, event):
+        index = int(self.canvas.canvasx(event.x) // CELL_SIZE)
+        if 0 <= index < len(self.names):
+            self.on_select(index)
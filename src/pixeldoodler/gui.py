@@ -1,30 +1,105 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
-from PIL import Image, ImageTk, ImageDraw, ImageColor
+from PIL import Image, ImageTk, ImageDraw
 import numpy as np
+import bisect
 import os
+import multiprocessing
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 try:
     from tkinterdnd2 import DND_FILES, TkinterDnD
     HAS_DND = True
 except ImportError:
     HAS_DND = False
 
-# Predefined colours with numbers assigned, change this if more classes are required
-PREDEFINED_COLOURS = [
-    (1, "Red",    "#ff0000"),
-    (2, "Blue",   "#0000ff"),
-    (3, "Green",  "#00ff00"),
-    (4, "Yellow", "#ffff00"),
-    (5, "Purple", "#800080"),
-]
-
-COLOUR_TO_NUMBER = {hex_color: number for number, name, hex_color in PREDEFINED_COLOURS}
-NUMBER_TO_COLOUR = {number: hex_color for number, name, hex_color in PREDEFINED_COLOURS}
+from .filmstrip import Filmstrip
+from .fill import flood_fill
+from .history import HISTORY_TILE, StrokeHistory
+from .index import FolderIndex
+from .instrument import start_from_environment, tracer
+from .journal import CLEAR_RECORD, Journal, header_matches, read_journal
+from .loaders import NpyStack, file_key, is_stack, npy_to_image, read_image
+from .pack import open_pack
+from .prelabel import PRELABEL_ENV, prelabel_file
+from .superpixels import load_superpixels
+from .tiled import TiledImage, TiledMask, open_tiled
+from .masks import (
+    CLASS_KEYS,
+    PREDEFINED_COLOURS,
+    NUMBER_TO_COLOUR,
+    MASK_DTYPE,
+    MASK_FORMATS,
+    OVERLAY_LUT,
+    load_labels,
+    mask_paths,
+    save_mask,
+)
+
+# Zoom slider positions are snapped to this step so resampled images can be reused
+ZOOM_STEP = 0.05
+# Side length in display pixels of the tiles the canvas is rendered in
+TILE_SIZE = 256
+# Number of resampled base tiles kept around (least recently used are dropped)
+TILE_CACHE_SIZE = 512
+# Stop halving the image pyramid once a level gets this small
+PYRAMID_MIN_SIZE = 256
+# How many files after / before the current one are decoded in the background
+PREFETCH_AHEAD = 3
+PREFETCH_BEHIND = 1
+# How many planes either side of the current one are prepared for .npy stacks
+SLICE_PREFETCH = 2
+# How many files after the current one the pre-label plugin is run on, and in how many processes
+PRELABEL_AHEAD = 4
+PRELABEL_WORKERS = 2
+# Painting redraws at most once per this many milliseconds (about 60 fps)
+FRAME_INTERVAL_MS = 16
+# Memory the undo/redo history may use before the oldest strokes are dropped
+HISTORY_MAX_BYTES = 64 * 1024 * 1024
+# Percentiles that "Auto contrast" clips 16-bit / float data to
+CONTRAST_PERCENTILES = (0.5, 99.5)
+# Painting tools. "Superpixels" paints whole superpixels under the brush;
+# the fill tools label the connected region under the click
+FILL_TOOLS = ("Fill label", "Fill intensity")
+TOOLS = ("Brush", "Superpixels") + FILL_TOOLS
+# On tiled (gigapixel) images fills only search a square this big around the click
+TILED_FILL_SIZE = 4096
+# How often the timing statistics in the status bar are refreshed while tracing
+PERF_HUD_INTERVAL_MS = 500
+# Stages shown in the status bar while tracing, with their labels
+PERF_HUD_STAGES = (("render", "render"), ("paint_latency", "paint lag"), ("decode", "decode"))
+
+
+def _read_saved(image_path):
+    """The saved mask of a file and the journal of its unsaved edits (or Nones)."""
+    try:
+        unsaved = read_journal(image_path)
+    except OSError:
+        unsaved = None
+    return load_labels(image_path), unsaved
+
+
+def _write_mask(mask, path, png_path, journal):
+    """
+    Save a mask, then drop the journal of the edits it now contains.
+    Returns the mtime of the mask's folder before and after the write.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    before = os.stat(folder).st_mtime_ns
+    save_mask(mask, path, png_path)
+    after = os.stat(folder).st_mtime_ns
+    if journal is not None:
+        journal.discard()
+    return before, after
 
 
 class Doodler:
     def __init__(self):
+        start_from_environment()
         if HAS_DND:
             self.root = TkinterDnD.Tk()
         else:
@@ -48,25 +123,76 @@ class Doodler:
         style.configure("TLabelframe.Label", font=("Segoe UI", 10, "bold"))
 
         self.image = None
-        self.mask = None
-        self.draw = None
-        self.stroke_stack = []
-        self.erased_strokes = []
+        self.mask = None  # label map, one class number per pixel
+        self.stroke_stack = StrokeHistory(max_bytes=HISTORY_MAX_BYTES, on_change=self._journal_edit)
+        # Unsaved edits of the current file, appended by the save writer after every stroke
+        self.journal = None
         self.brush_color = PREDEFINED_COLOURS[0][2]
         self.brush_size = 5.0
         self.brush_number = PREDEFINED_COLOURS[0][0]
         self.last_x, self.last_y = None, None
+        self.pending_points = []
+        self.paint_job = None
+        self.last_paint_time = 0.0
+        self.paint_queued_time = 0.0  # when the oldest queued motion event arrived
+        self.load_started = 0.0
         self.has_strokes = False
         self.zoom_level = 1.0
         self.min_zoom = 0.5
         self.max_zoom = 3.0
+        self.contrast_percentiles = None
         self.image_files = []
         self.current_index = -1
+        # Index of the open folder, filled in the background by scan_pool
+        self.folder_index = None
+        self.scan_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scan")
+        self.thumb_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbs")
         self.current_folder = ""
         self.is_eraser = False
+        self.tool = TOOLS[0]
+        self.gray = None  # grayscale copy of the image for intensity fills, made on demand
+        # Over-segmentation of the current image (or plane) for the superpixel tool,
+        # computed in the background; superpixel_key says which image it is for
+        self.superpixels = None
+        self.superpixel_key = None
+        self.stroke_segments = None
         self.brush_preview_id = None
         self.preview_x, self.preview_y = None, None
 
+        # Render cache: image pyramid, resampled base tiles and the tiles on the canvas
+        self.pyramid = []
+        self.tile_cache = OrderedDict()
+        self.tile_items = {}
+        self.render_size = None
+        self.render_pending = False
+
+        # Background decoding of neighbouring files, keyed by path
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+        self.prefetched = {}
+        self.pending_load = None
+        # The file being opened, until it is shown; slice and contrast changes
+        # must not replace its load, or the old file's mask would stay open
+        self.loading_file = None
+        # Pre-decoded images of the open folder (see pack.py), if it has been packed
+        self.pack = None
+
+        # Pre-labelling of upcoming files by a model plugin (see prelabel.py), keyed by path.
+        # Plugins may be slow or hold the GIL, so they get processes of their own.
+        self.prelabel_spec = os.environ.get(PRELABEL_ENV) or None
+        self.prelabel_pool = None
+        self.prelabelled = {}
+
+        # Multi-plane .npy files: the open stack, its current plane and one mask per plane
+        self.stack = None
+        self.slice_index = 0
+        self.slice_masks = {}
+        self.slice_prefetched = {}
+
+        # Masks are written by a single background writer, in the order queued
+        self.async_save = True
+        self.save_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save")
+        self.pending_saves = []
+
         # empty-state message on canvas
         self.empty_message_id = None
 
@@ -85,6 +211,8 @@ class Doodler:
             )
 
         self.show_empty_message()
+        if tracer.enabled:
+            self.root.after(PERF_HUD_INTERVAL_MS, self._update_perf_label)
 
     # UI
     def _build_layout(self):
@@ -106,19 +234,43 @@ class Doodler:
         self.next_button = ttk.Button(nav_frame, text="Next ▶", command=self.next_image, state=tk.DISABLED)
         self.next_button.pack(side=tk.LEFT, padx=2)
 
+        self.unlabelled_button = ttk.Button(
+            nav_frame, text="Next Unlabelled ⏭", command=self.next_unlabelled, state=tk.DISABLED
+        )
+        self.unlabelled_button.pack(side=tk.LEFT, padx=2)
+
         brush_frame = ttk.LabelFrame(top, text="Brush")
         brush_frame.pack(side=tk.LEFT, padx=15)
 
+        ttk.Label(brush_frame, text="Tool:").pack(side=tk.LEFT, padx=(4, 2))
+        self.tool_var = tk.StringVar(self.root, self.tool)
+        self.tool_combo = ttk.Combobox(
+            brush_frame,
+            textvariable=self.tool_var,
+            values=TOOLS,
+            state="readonly",
+            width=12,
+        )
+        self.tool_combo.bind("<<ComboboxSelected>>", self._on_tool_combo)
+        self.tool_combo.pack(side=tk.LEFT, padx=(0, 6))
+
         ttk.Label(brush_frame, text="Class:").pack(side=tk.LEFT, padx=(4, 2))
-        self.selected_color = tk.StringVar(self.root, PREDEFINED_COLOURS[0][1])
+        # Editable so that typing filters the classes (by name or number)
+        self.class_labels = {
+            number: f"{number} \u00b7 {name}" for number, name, _ in PREDEFINED_COLOURS
+        }
+        self.selected_color = tk.StringVar(self.root, self.class_labels[self.brush_number])
         self.color_combo = ttk.Combobox(
             brush_frame,
             textvariable=self.selected_color,
-            values=[name for _, name, _ in PREDEFINED_COLOURS],
-            state="readonly",
-            width=10,
+            values=list(self.class_labels.values()),
+            width=16,
         )
         self.color_combo.bind("<<ComboboxSelected>>", self._on_color_combo)
+        self.color_combo.bind("<KeyRelease>", self._filter_classes)
+        self.color_combo.bind("<Return>", self._on_color_combo)
+        self.color_combo.bind("<Escape>", self._end_class_search)
+        self.color_combo.bind("<FocusOut>", self._end_class_search)
         self.color_combo.pack(side=tk.LEFT, padx=(0, 6))
 
         # colour swatch
@@ -157,6 +309,30 @@ class Doodler:
         )
         self.erase_button.pack(side=tk.LEFT, padx=(10, 4))
 
+        # Intensity difference from the clicked pixel that "Fill intensity" still includes
+        ttk.Label(brush_frame, text="Tolerance:").pack(side=tk.LEFT, padx=(6, 2))
+        self.tolerance_var = tk.IntVar(value=10)
+        self.tolerance_spin = ttk.Spinbox(
+            brush_frame, from_=0, to=255, textvariable=self.tolerance_var, width=4
+        )
+        self.tolerance_spin.pack(side=tk.LEFT, padx=(0, 4))
+
+        slice_frame = ttk.LabelFrame(top, text="Slice")
+        slice_frame.pack(side=tk.LEFT, padx=(0, 15))
+
+        self.slice_label = ttk.Label(slice_frame, text="–", width=10)
+        self.slice_label.pack(side=tk.LEFT, padx=(4, 2))
+
+        self.slice_slider = ttk.Scale(
+            slice_frame,
+            from_=0,
+            to=1,
+            orient=tk.HORIZONTAL,
+            state=tk.DISABLED,
+        )
+        self.slice_slider.configure(command=self._on_slice_slider)
+        self.slice_slider.pack(side=tk.LEFT, padx=4, ipadx=20)
+
         right_frame = ttk.Frame(top)
         right_frame.pack(side=tk.RIGHT)
 
@@ -176,25 +352,59 @@ class Doodler:
         self.zoom_slider.configure(command=self.update_zoom)
         self.zoom_slider.pack(side=tk.LEFT, padx=4, ipadx=40)
 
+        self.contrast_var = tk.BooleanVar(value=False)
+        self.contrast_button = ttk.Checkbutton(
+            zoom_frame,
+            text="Auto contrast",
+            variable=self.contrast_var,
+            command=self.toggle_auto_contrast
+        )
+        self.contrast_button.pack(side=tk.LEFT, padx=(6, 4))
+
         actions_frame = ttk.Frame(right_frame)
         actions_frame.pack(side=tk.LEFT)
 
+        self.undo_button = ttk.Button(actions_frame, text="Undo", command=self.undo)
+        self.undo_button.pack(side=tk.LEFT, padx=(4, 0))
+
+        self.redo_button = ttk.Button(actions_frame, text="Redo", command=self.redo)
+        self.redo_button.pack(side=tk.LEFT, padx=(2, 4))
+
         self.clear_button = ttk.Button(actions_frame, text="Clear Mask", command=self.clear_mask)
         self.clear_button.pack(side=tk.LEFT, padx=4)
 
-        self.save_button = ttk.Button(actions_frame, text="Save Mask", command=self.save_brush_strokes)
+        self.save_button = ttk.Button(
+            actions_frame, text="Save Mask", command=lambda: self.save_brush_strokes(report=True)
+        )
         self.save_button.pack(side=tk.LEFT, padx=4)
 
+        # Format the label map is saved in, and whether a colour PNG preview is written too
+        self.format_var = tk.StringVar(self.root, "npy")
+        self.format_combo = ttk.Combobox(
+            actions_frame,
+            textvariable=self.format_var,
+            values=list(MASK_FORMATS),
+            state="readonly",
+            width=5,
+        )
+        self.format_combo.pack(side=tk.LEFT, padx=(0, 4))
+
+        self.preview_var = tk.BooleanVar(value=True)
+        self.preview_button = ttk.Checkbutton(
+            actions_frame, text="PNG preview", variable=self.preview_var
+        )
+        self.preview_button.pack(side=tk.LEFT, padx=(0, 4))
+
         center = ttk.Frame(self.root)
         center.pack(fill=tk.BOTH, expand=True, padx=6, pady=(0, 6))
 
         self.canvas = tk.Canvas(center, bg="#1e1e1e", highlightthickness=0)
         self.canvas.grid(row=0, column=0, sticky="nsew")
 
-        vbar = ttk.Scrollbar(center, orient=tk.VERTICAL, command=self.canvas.yview)
+        vbar = ttk.Scrollbar(center, orient=tk.VERTICAL, command=self._on_yscroll)
         vbar.grid(row=0, column=1, sticky="ns")
 
-        hbar = ttk.Scrollbar(center, orient=tk.HORIZONTAL, command=self.canvas.xview)
+        hbar = ttk.Scrollbar(center, orient=tk.HORIZONTAL, command=self._on_xscroll)
         hbar.grid(row=1, column=0, sticky="ew")
 
         self.canvas.configure(xscrollcommand=hbar.set, yscrollcommand=vbar.set)
@@ -213,15 +423,40 @@ class Doodler:
         self.pos_label = ttk.Label(status, text="", width=20, anchor="e")
         self.pos_label.pack(side=tk.RIGHT)
 
+        # Rolling stage timings, only shown while tracing
+        self.perf_label = ttk.Label(status, text="", anchor="e")
+        if tracer.enabled:
+            self.perf_label.pack(side=tk.RIGHT, padx=(0, 10))
+
+        self.save_label = ttk.Label(status, text="", anchor="e")
+        self.save_label.pack(side=tk.RIGHT, padx=(0, 10))
+
+        self.filmstrip = Filmstrip(self.root, self.go_to_image, self.thumb_pool)
+        self.filmstrip.frame.pack(side=tk.BOTTOM, fill=tk.X, padx=6)
+
     def _bind_events(self):
+        self.canvas.bind("<ButtonPress-1>", self.start_stroke)
         self.canvas.bind("<B1-Motion>", self.paint)
         self.canvas.bind("<Motion>", self.update_brush_preview)
         self.root.bind("<ButtonRelease-1>", self.reset_last_coords)
+        self.root.bind("<Control-z>", self.undo)
+        self.root.bind("<Control-y>", self.redo)
+        self.root.bind("<Control-Z>", self.redo)
         self.root.bind("<space>", self.next_image)
+        self.root.bind("<Shift-space>", self.next_unlabelled)
+        self.root.bind("<Prior>", self.previous_slice)
+        self.root.bind("<Next>", self.next_slice)
+        self.root.bind("<Key>", self._on_class_key)
+        self.root.bind("<bracketleft>", lambda e: self._cycle_class(e, -1))
+        self.root.bind("<bracketright>", lambda e: self._cycle_class(e, 1))
+        self.root.bind("<Control-f>", self._start_class_search)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def show_empty_message(self):
         """Show center message on the canvas when no image is loaded."""
         self.canvas.delete("all")
+        self.tile_items.clear()
+        self.render_size = None
         self.brush_preview_id = None
 
         w = self.canvas.winfo_width() or 600
@@ -244,6 +479,15 @@ class Doodler:
         """Keep the empty message centered if it exists."""
         if self.empty_message_id is not None:
             self.canvas.coords(self.empty_message_id, event.width // 2, event.height // 2)
+        self.schedule_render()
+
+    def _on_xscroll(self, *args):
+        self.canvas.xview(*args)
+        self.schedule_render()
+
+    def _on_yscroll(self, *args):
+        self.canvas.yview(*args)
+        self.schedule_render()
 
     def _init_dnd(self):
         """
@@ -286,123 +530,623 @@ class Doodler:
         """
         Load a folder path directly (used by dialog and drag & drop).
         Accepts both image files and .npy files.
+
+        The file list comes from the folder's cached index when it is still
+        current. Otherwise the folder is scanned in the background and the
+        list fills in as the scan goes; the first image is shown as soon as
+        one has been found.
         """
-        self.image_files = [
-            f for f in os.listdir(folder_path)
-            if f.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".tif", ".tiff", ".npy"))
-        ]
-        self.image_files.sort()
+        self._leave_image(save=False)
+        self._close_index()
+        self.folder_index = FolderIndex(folder_path)
+        self.current_folder = folder_path
+        self.current_index = -1
+        self.image_files = []
+        self.pack = open_pack(folder_path)
+
+        if not self.folder_index.load():
+            self.status_label.config(text=f"Scanning {folder_path}…")
+            self.scan_pool.submit(self.folder_index.scan)
+        self._update_file_list()
+        if not self.folder_index.complete:
+            self.root.after(50, self._poll_index, self.folder_index)
+
+    def _poll_index(self, index):
+        if index is not self.folder_index:
+            return  # another folder has been opened since
+        try:
+            changed = index.poll()
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to read the folder:\n{index.folder}\n\n{e}")
+            return
+        if changed:
+            self._update_file_list()
+        if not index.complete:
+            self.root.after(50, self._poll_index, index)
+
+    def _update_file_list(self):
+        """Take over the index's file list, keeping the current image selected."""
+        index = self.folder_index
+        current = self.image_files[self.current_index] if self.current_index >= 0 else None
+        # A copy: the index sorts new names into its own list while the scan goes on
+        self.image_files = list(index.names)
+        self.filmstrip.set_files(self.current_folder, self.image_files)
+
+        if current is not None:
+            position = bisect.bisect_left(self.image_files, current)
+            if position < len(self.image_files) and self.image_files[position] == current:
+                self.current_index = position
+            else:
+                # The file has been deleted: move on to whatever took its place
+                self._leave_image(save=False)
+                self.current_index = min(position, len(self.image_files) - 1)
+                if self.current_index >= 0:
+                    self.load_image(self.image_files[self.current_index])
+        elif self.image_files:
+            self.current_index = 0
+            self.load_image(self.image_files[self.current_index])
 
-        if not self.image_files:
+        self.update_navigation_buttons()
+        if index.complete and not self.image_files:
             messagebox.showerror("Error", "No image or .npy files found in the selected folder.")
+        elif self.pending_load is None:
+            self.status_label.config(text=self._folder_status())
+
+    def _folder_status(self):
+        index = self.folder_index
+        if not index.complete:
+            return f"Scanning {index.folder}… {len(index):,} files so far"
+        return f"Loaded {len(index):,} files from {index.folder} ({index.labelled:,} labelled)"
+
+    def _close_index(self):
+        if self.folder_index is not None:
+            self.folder_index.cancel()
+            if self.folder_index.dirty:
+                self.folder_index.save()
+
+    def next_unlabelled(self, event=None):
+        """Jump to the next image (wrapping around) that has no saved mask yet."""
+        if event is not None and self._typing(event):
+            return
+        if self.folder_index is None or self.current_index < 0:
+            return
+        if not self._leave_image():
             return
+        position = self.folder_index.next_unlabelled(self.current_index)
+        if position is None:
+            self.status_label.config(text="Every image has a mask.")
+            return
+        self.go_to_image(position, save=False)
 
-        self.current_folder = folder_path
-        self.current_index = 0
+    def go_to_image(self, index, save=True):
+        """Show the image at index in the file list, saving pending edits first."""
+        if save and not self._leave_image():
+            return
+        if index == self.current_index:
+            return
+        self.current_index = index
         self.load_image(self.image_files[self.current_index])
         self.update_navigation_buttons()
-        self.status_label.config(
-            text=f"Loaded {len(self.image_files)} files from {folder_path}"
-        )
+
+    def _leave_image(self, save=True):
+        """
+        Settle the edits of the shown file before another one is opened:
+        save them, or with save=False leave them in its journal for the next
+        session. Returns False if saving failed.
+
+        While a file is being opened the mask is still the previous file's,
+        so edits made in the meantime can only go to the journal.
+        """
+        self.flush_paint()
+        if not self.has_strokes:
+            return True
+        if save and self.loading_file is None:
+            return self.save_brush_strokes()
+        self._drop_edits()
+        return True
+
+    def _drop_edits(self):
+        """Forget the shown file's unsaved edits; its journal keeps them."""
+        self.has_strokes = False
+        self.stroke_stack.clear()
+        if self.journal is not None:
+            self.save_pool.submit(self.journal.close)
+            self.journal = None
 
     def _npy_to_image(self, array):
+        """Convert a numpy array to a Pillow RGBA image for display."""
+        return npy_to_image(array)
+
+    def _prepare_image(self, image_path):
         """
-        Convert a numpy array to a Pillow RGBA image for display.
-        Handles:
-        - 2D arrays -> grayscale
-        - 3D arrays with channels last (H, W, C)
-        """
-        arr = np.array(array)
-
-        # If it's boolean, map to 0/255
-        if arr.dtype == bool:
-            arr = arr.astype(np.uint8) * 255
-
-        if arr.ndim == 2:
-            # normalize to 0-255 if not already
-            arr = arr.astype(np.float32)
-            min_val, max_val = arr.min(), arr.max()
-            if max_val > min_val:
-                arr = (arr - min_val) / (max_val - min_val) * 255.0
-            arr = arr.astype(np.uint8)
-            img = Image.fromarray(arr, mode="L").convert("RGBA")
-            return img
-
-        if arr.ndim == 3:
-            if arr.shape[0] in (1, 3, 4) and arr.shape[2] not in (1, 3, 4):
-                arr = np.transpose(arr, (1, 2, 0))
-
-            if arr.shape[2] == 1:
-                arr = arr[:, :, 0]
-                return self._npy_to_image(arr)
-
-            if arr.shape[2] in (3, 4):
-                if arr.dtype != np.uint8:
-                    arr = arr.astype(np.float32)
-                    min_val, max_val = arr.min(), arr.max()
-                    if max_val > min_val:
-                        arr = (arr - min_val) / (max_val - min_val) * 255.0
-                    arr = arr.astype(np.uint8)
-
-                mode = "RGB" if arr.shape[2] == 3 else "RGBA"
-                img = Image.fromarray(arr, mode=mode)
-                if mode == "RGB":
-                    img = img.convert("RGBA")
-                return img
-
-        arr = arr.astype(np.float32)
-        arr = (arr - arr.min()) / (arr.max() - arr.min() + 1e-8) * 255.0
-        arr = arr.astype(np.uint8)
-        if arr.ndim >= 2:
-            arr = arr[..., 0]
-        img = Image.fromarray(arr, mode="L").convert("RGBA")
-        return img
+        Decode a file and build its pyramid. Runs on a prefetch worker.
+        Multi-plane .npy files come back as an NpyStack showing its first plane,
+        gigapixel ones as a TiledImage that reads only what is shown. Files in
+        the folder's pack are not decoded at all.
+        """
+        with tracer.span("decode", file=os.path.basename(image_path)):
+            stack = None
+            percentiles = self.contrast_percentiles
+            pack = self.pack
+            if pack is not None and percentiles is None:
+                pyramid = pack.levels(image_path)
+                if pyramid is not None:
+                    return pyramid[0], pyramid, None
+            tiled = open_tiled(image_path, percentiles)
+            if tiled is not None:
+                return tiled, tiled.levels, None
+            if image_path.lower().endswith(".npy"):
+                arr = np.load(image_path, mmap_mode="r")
+                if is_stack(arr):
+                    stack = NpyStack(arr, percentiles, file_key(image_path))
+                    image = stack.plane_image(0)
+                else:
+                    with tracer.span("npy_to_image"):
+                        image = npy_to_image(arr, percentiles, file_key(image_path))
+            else:
+                image = read_image(image_path, percentiles)
+            return image, self._build_pyramid(image), stack
+
+    def _prepare_slice(self, stack, index):
+        """Convert one plane of a stack and build its pyramid. Runs on a prefetch worker."""
+        image = stack.plane_image(index)
+        return image, self._build_pyramid(image)
+
+    def prefetch_neighbours(self):
+        """
+        Queue decoding of the files around the current index and forget
+        prefetched results that have fallen out of that window.
+        """
+        first = max(0, self.current_index - PREFETCH_BEHIND)
+        last = min(len(self.image_files), self.current_index + PREFETCH_AHEAD + 1)
+        wanted = [
+            os.path.join(self.current_folder, f) for f in self.image_files[first:last]
+        ]
+
+        for path in list(self.prefetched):
+            if path not in wanted:
+                self.prefetched.pop(path).cancel()
+
+        for path in wanted:
+            if path not in self.prefetched:
+                self.prefetched[path] = self.prefetch_pool.submit(self._prepare_image, path)
+
+    def prefetch_slices(self):
+        """Same as prefetch_neighbours, for the planes around the current slice."""
+        first = max(0, self.slice_index - SLICE_PREFETCH)
+        last = min(self.stack.num_planes, self.slice_index + SLICE_PREFETCH + 1)
+
+        for index in list(self.slice_prefetched):
+            if not first <= index < last:
+                self.slice_prefetched.pop(index).cancel()
+
+        for index in range(first, last):
+            if index not in self.slice_prefetched:
+                self.slice_prefetched[index] = self.prefetch_pool.submit(
+                    self._prepare_slice, self.stack, index
+                )
+
+    def _when_ready(self, key, future, callback):
+        """
+        Run callback(future) on the Tk thread once future has finished,
+        polling from the event loop. If another load is started in the
+        meantime (a different key), the callback is dropped.
+        """
+        self.pending_load = key
+        if future.done():
+            self.pending_load = None
+            callback(future)
+        else:
+            self.root.after(10, self._poll_load, key, future, callback)
+
+    def _poll_load(self, key, future, callback):
+        if self.pending_load != key:
+            return  # the user has moved on to another file
+        if future.done():
+            self.pending_load = None
+            callback(future)
+        else:
+            self.root.after(10, self._poll_load, key, future, callback)
 
     def load_image(self, image_file):
+        """
+        Show a file from the current folder. Uses the prefetched result when
+        there is one; otherwise decoding runs in the background and the
+        image appears once it is ready, so the UI never blocks on disk I/O.
+
+        A mask saved earlier for the file is loaded too, so work can be
+        resumed, along with any journal of edits that were never saved. They
+        are read on the save writer's queue, which means they come after any
+        save of that file that is still pending.
+        """
         image_path = os.path.join(self.current_folder, image_file)
+        self.load_started = time.perf_counter()
+        self.loading_file = image_path
+        future = self.prefetched.get(image_path)
+        if future is None or future.cancelled():
+            future = self.prefetch_pool.submit(self._prepare_image, image_path)
+            self.prefetched[image_path] = future
+        labels_future = self.save_pool.submit(_read_saved, image_path)
+
+        self.prefetch_neighbours()
+        self.prelabel_upcoming()
+        if not future.done():
+            self.status_label.config(text=f"Loading {image_file}…")
+        self._when_ready(
+            image_path, future, lambda f: self._when_ready(
+                image_path, labels_future,
+                lambda lf: self._finish_load(image_file, image_path, f, lf),
+            )
+        )
+
+    def _finish_load(self, image_file, image_path, future, labels_future):
+        self.loading_file = None
         try:
-            if image_file.lower().endswith(".npy"):
-                arr = np.load(image_path)
-                self.image = self._npy_to_image(arr)
+            image, pyramid, stack = future.result()
+        except Exception as e:
+            self.prefetched.pop(image_path, None)
+            # The previous file's mask must not be saved under this file's name
+            self._close_image()
+            if isinstance(e, FileNotFoundError):
+                messagebox.showerror("Error", f"File not found: {image_path}")
             else:
-                self.image = Image.open(image_path).convert("RGBA")
-        except FileNotFoundError:
-            messagebox.showerror("Error", f"File not found: {image_path}")
+                messagebox.showerror("Error", f"Failed to load file:\n{image_path}\n\n{e}")
             return
+
+        self.stack = stack
+        self.slice_index = 0
+        self.slice_masks = {}
+        for pending in self.slice_prefetched.values():
+            pending.cancel()
+        self.slice_prefetched = {}
+
+        status = f"{image_file} ({self.current_index+1}/{len(self.image_files)})"
+        try:
+            labels, unsaved = labels_future.result()
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to load file:\n{image_path}\n\n{e}")
-            return
+            labels, unsaved = None, None
+            status += f" - could not read its saved mask: {e}"
+        if labels is not None:
+            masks = self._fit_labels(labels, image, stack)
+            if masks is not None:
+                self.slice_masks = masks
+                status += " - saved mask loaded"
+            else:
+                status += f" - saved mask ignored, its shape {labels.shape} does not match"
 
-        self.mask = Image.new("RGBA", self.image.size, (0, 0, 0, 0))
-        self.draw = ImageDraw.Draw(self.mask)
+        self._set_image(image, pyramid)
+        self._update_zoom_range(image)
         self.stroke_stack.clear()
-        self.erased_strokes.clear()
+        # Only edits made from here on make the image need saving again
         self.has_strokes = False
+        status += self._open_journal(image_file, image_path, unsaved)
+        if labels is None and not self.has_strokes and not isinstance(image, TiledImage):
+            status += self._start_prelabel(image_file, image_path)
+        self.request_superpixels()
 
         self.display_image()
-        self.status_label.config(text=f"{image_file} ({self.current_index+1}/{len(self.image_files)})")
+        self.update_slice_controls()
+        self.status_label.config(text=status)
+        tracer.record("load", time.perf_counter() - self.load_started, file=image_file)
 
-    def display_image(self):
-        if self.image is None:
-            self.show_empty_message()
+        if self.stack is not None:
+            self.prefetch_slices()
+
+    def _close_image(self):
+        """Take the shown file off the canvas, leaving its unsaved edits in its journal."""
+        self._drop_edits()
+        self._set_base(None, [])
+        self.mask = None
+        self.stack = None
+        self.slice_masks = {}
+        self.display_image()
+        self.update_slice_controls()
+
+    def _fit_labels(self, labels, image, stack):
+        """A label map read for a file as {plane: mask}, or None if its shape does not fit the file."""
+        if stack is not None and labels.size == stack.num_planes * stack.height * stack.width:
+            return dict(enumerate(labels.reshape(stack.num_planes, stack.height, stack.width)))
+        if stack is None and labels.shape == (image.height, image.width):
+            return {0: labels}
+        return None
+
+    def prelabel_upcoming(self):
+        """
+        Queue the pre-label plugin on the current file and the next few in
+        worker processes, and forget results that fell out of that window.
+        Finished results are cached on disk, so forgetting them is cheap.
+        """
+        if not self.prelabel_spec or self.current_index < 0:
+            return
+        last = min(len(self.image_files), self.current_index + PRELABEL_AHEAD + 1)
+        wanted = [
+            os.path.join(self.current_folder, f) for f in self.image_files[self.current_index:last]
+        ]
+
+        for path in list(self.prelabelled):
+            if path not in wanted:
+                self.prelabelled.pop(path).cancel()
+
+        for path in wanted:
+            future = self.prelabelled.get(path)
+            # Cancelled when its pool was replaced; exception() would raise for those
+            if future is None or future.cancelled() or (future.done() and future.exception() is not None):
+                self.prelabelled[path] = self._submit_prelabel(path)
+
+    def _submit_prelabel(self, path):
+        if self.prelabel_pool is not None:
+            try:
+                return self.prelabel_pool.submit(prelabel_file, self.prelabel_spec, path)
+            except BrokenProcessPool:
+                # A plugin took its worker down (e.g. out of memory): start new ones
+                self.prelabel_pool.shutdown(wait=False, cancel_futures=True)
+        # Forking a process that runs Tk and worker threads is not safe
+        self.prelabel_pool = ProcessPoolExecutor(
+            max_workers=PRELABEL_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+        return self.prelabel_pool.submit(prelabel_file, self.prelabel_spec, path)
+
+    def _start_prelabel(self, image_file, image_path):
+        """
+        Use the plugin's label map as the starting mask of a file without a
+        saved one, now or once it is ready. Returns a note for the status bar.
+        """
+        future = self.prelabelled.get(image_path)
+        if future is None:
+            return ""
+        if future.done():
+            return self._apply_prelabel(future)
+        self.root.after(50, self._poll_prelabel, image_file, image_path, future)
+        return " - pre-labelling…"
+
+    def _poll_prelabel(self, image_file, image_path, future):
+        current = self.image_files[self.current_index] if 0 <= self.current_index < len(self.image_files) else None
+        if self.prelabelled.get(image_path) is not future or current != image_file or self.pending_load:
+            return  # the user has moved on to another file
+        if not future.done():
+            self.root.after(50, self._poll_prelabel, image_file, image_path, future)
+            return
+        note = self._apply_prelabel(future)
+        self.status_label.config(text=f"{image_file} ({self.current_index+1}/{len(self.image_files)}){note}")
+
+    def _apply_prelabel(self, future):
+        if future.cancelled():
+            return ""
+        try:
+            cache_path = future.result()
+            labels = None if cache_path is None else np.load(cache_path)
+        except Exception as e:
+            return f" - pre-labelling failed: {e}"
+        if labels is None:
+            return ""
+        if self.has_strokes:
+            # Never overwrite the annotator's own work
+            return " - pre-labels arrived after editing started and were not applied"
+        masks = self._fit_labels(labels, self.image, self.stack)
+        if masks is None:
+            return f" - pre-labels ignored, their shape {labels.shape} does not match"
+        _, height, width = self._journal_shape()
+        for plane, plane_labels in masks.items():
+            mask = self.slice_masks.get(plane)
+            if mask is None:
+                mask = self.slice_masks[plane] = np.zeros((height, width), dtype=MASK_DTYPE)
+            # An edit like any other: journalled, undoable, and saved when moving on
+            self.stroke_stack.begin(mask)
+            self.stroke_stack.touch(0, 0, width, height)
+            mask[...] = plane_labels
+            if self.stroke_stack.end():
+                self.has_strokes = True
+        if not self.has_strokes:
+            return " - the pre-label plugin found nothing to label"
+        self.display_image()
+        return " - pre-labelled, correct it and save (Ctrl+Z removes it)"
+
+    def _journal_shape(self):
+        if self.stack is not None:
+            return self.stack.num_planes, self.stack.height, self.stack.width
+        return 1, self.image.height, self.image.width
+
+    def _open_journal(self, image_file, image_path, unsaved):
+        """
+        Start journalling the edits of a newly opened file. If edits that
+        were never saved (after a crash) were found, offer to restore them.
+        Returns a note for the status bar.
+        """
+        if self.journal is not None:
+            self.save_pool.submit(self.journal.close)
+        shape = self._journal_shape()
+        self.journal = Journal(image_path, shape, np.dtype(MASK_DTYPE).str, HISTORY_TILE)
+        if unsaved is None:
+            return ""
+        header, records = unsaved
+        planes, height, width = shape
+        # A journal of another version of the file, or a damaged one, can't be replayed
+        if not records or not header_matches(header, shape, self.journal.dtype, HISTORY_TILE) or any(
+            plane >= planes or ty * HISTORY_TILE >= height or tx * HISTORY_TILE >= width
+            for _, plane, ty, tx, _ in records
+        ):
+            self.save_pool.submit(self.journal.discard)
+            return ""
+        if not messagebox.askyesno(
+            "Unsaved edits",
+            f"{image_file} has edits from an earlier session that were never saved.\n\nRestore them?",
+        ):
+            self.save_pool.submit(self.journal.discard)
+            return ""
+        self._replay_journal(records)
+        self.has_strokes = True
+        return f" - {len(records):,} unsaved tile edits restored"
+
+    def _replay_journal(self, records):
+        """Write journalled tiles back into the masks of the planes they belong to."""
+        _, height, width = self._journal_shape()
+        for kind, plane, ty, tx, data in records:
+            mask = self.slice_masks.get(plane)
+            if mask is None:
+                mask = np.zeros((height, width), dtype=MASK_DTYPE)
+                self.slice_masks[plane] = mask
+            if kind == CLEAR_RECORD:
+                if isinstance(mask, TiledMask):
+                    mask.clear()
+                else:
+                    mask[...] = 0
+                continue
+            top, left = ty * HISTORY_TILE, tx * HISTORY_TILE
+            bottom, right = min(height, top + HISTORY_TILE), min(width, left + HISTORY_TILE)
+            mask[top:bottom, left:right] = np.frombuffer(zlib.decompress(data), dtype=MASK_DTYPE).reshape(
+                bottom - top, right - left
+            )
+
+    def _journal_edit(self, mask, tiles):
+        """Queue the tiles a stroke, undo or redo changed for the journal."""
+        journal = self.journal
+        if journal is None:
+            return
+        if journal.error is not None:
+            self.status_label.config(text=f"Unsaved edits are not being journalled: {journal.error}")
+            self.journal = None
+            return
+        plane = next((index for index, m in self.slice_masks.items() if m is mask), None)
+        if plane is not None:
+            self.save_pool.submit(journal.append, plane, tiles)
+
+    def _set_image(self, image, pyramid):
+        """Install a new base image, with the mask of the current slice."""
+        self._set_base(image, pyramid)
+        self.mask = self.slice_masks.get(self.slice_index)
+        if isinstance(image, TiledImage) and not isinstance(self.mask, TiledMask):
+            # Only painted chunks are held in memory, the rest reads from the saved mask
+            self.mask = TiledMask((image.height, image.width), base=self.mask)
+            self.slice_masks[self.slice_index] = self.mask
+        elif self.mask is None:
+            self.mask = np.zeros((image.height, image.width), dtype=MASK_DTYPE)
+            self.slice_masks[self.slice_index] = self.mask
+
+    def _set_base(self, image, pyramid):
+        self.image, self.pyramid = image, pyramid
+        self.gray = None
+        self.tile_cache.clear()
+
+    def toggle_auto_contrast(self):
+        """
+        Switch between min/max and percentile-clipped display of the data.
+        Only the displayed image is rebuilt; the mask is left untouched.
+        """
+        if self.loading_file is not None:
+            # Try again once the file being opened is shown
+            self.root.after(50, self.toggle_auto_contrast)
+            return
+        self.contrast_percentiles = CONTRAST_PERCENTILES if self.contrast_var.get() else None
+
+        # Prefetched images were prepared with the old setting
+        for future in list(self.prefetched.values()) + list(self.slice_prefetched.values()):
+            future.cancel()
+        self.prefetched = {}
+        self.slice_prefetched = {}
+
+        if self.image is None or not self.image_files:
+            return
+
+        if self.stack is not None:
+            self.stack.set_percentiles(self.contrast_percentiles)
+            future = self.prefetch_pool.submit(self._prepare_slice, self.stack, self.slice_index)
+            self.slice_prefetched[self.slice_index] = future
+        else:
+            image_path = os.path.join(self.current_folder, self.image_files[self.current_index])
+            future = self.prefetch_pool.submit(self._prepare_image, image_path)
+            self.prefetched[image_path] = future
+
+        def finish(future):
+            try:
+                image, pyramid = future.result()[:2]
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to reload the image:\n{e}")
+                return
+            self._set_base(image, pyramid)
+            self.display_image()
+            self.request_superpixels()
+            self.prefetch_neighbours()
+            if self.stack is not None:
+                self.prefetch_slices()
+
+        self._when_ready(("contrast", future), future, finish)
+
+    # ------------------------------------------------------------------ Slices
+    def update_slice_controls(self):
+        if self.stack is None:
+            self.slice_slider.config(state=tk.DISABLED)
+            self.slice_label.config(text="–")
+            return
+        self.slice_slider.config(state=tk.NORMAL, to=max(1, self.stack.num_planes - 1))
+        self.slice_slider.set(self.slice_index)
+        self.slice_label.config(text=self.stack.plane_label(self.slice_index))
+
+    def _on_slice_slider(self, val):
+        if self.stack is not None:
+            self.show_slice(int(round(float(val))))
+
+    def next_slice(self, event=None):
+        if self.stack is not None:
+            self.show_slice(self.slice_index + 1)
+
+    def previous_slice(self, event=None):
+        if self.stack is not None:
+            self.show_slice(self.slice_index - 1)
+
+    def show_slice(self, index):
+        """Switch to another plane of the open stack, keeping each plane's mask."""
+        if self.loading_file is not None:
+            return  # the open stack belongs to the file being replaced
+        if index == self.slice_index or not 0 <= index < self.stack.num_planes:
             return
 
-        zoom_w = int(self.image.width * self.zoom_level)
-        zoom_h = int(self.image.height * self.zoom_level)
+        self.slice_index = index
+        future = self.slice_prefetched.get(index)
+        if future is None or future.cancelled():
+            future = self.prefetch_pool.submit(self._prepare_slice, self.stack, index)
+            self.slice_prefetched[index] = future
+        self.prefetch_slices()
+        self.update_slice_controls()
+
+        stack = self.stack
+        self._when_ready(
+            (stack, index), future, lambda f: self._finish_slice(stack, index, f)
+        )
 
-        zoomed_image = self.image.resize((zoom_w, zoom_h), Image.Resampling.LANCZOS)
-        zoomed_mask = self.mask.resize((zoom_w, zoom_h), Image.Resampling.NEAREST)
+    def _finish_slice(self, stack, index, future):
+        if stack is not self.stack:
+            return
+        try:
+            image, pyramid = future.result()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load slice {index}:\n{e}")
+            return
+        self._set_image(image, pyramid)
+        self.display_image()
+        self.request_superpixels()
 
-        combined_image = Image.alpha_composite(zoomed_image, zoomed_mask)
-        photo = ImageTk.PhotoImage(combined_image)
+    def stack_labels(self):
+        """
+        Label volume for the whole stack, shaped like the stack without any
+        colour channel axis. Planes that were never painted are all zeros.
+        """
+        volume = np.zeros((self.stack.num_planes, self.stack.height, self.stack.width), dtype=MASK_DTYPE)
+        for index, mask in self.slice_masks.items():
+            volume[index] = mask
+        return volume.reshape(self.stack.index_shape + volume.shape[1:])
+
+    def display_image(self):
+        """Drop everything on the canvas and render the visible tiles afresh."""
+        if self.image is None:
+            self.show_empty_message()
+            return
 
         self.canvas.delete("all")
+        self.tile_items.clear()
+        self.render_size = None
         self.empty_message_id = None  # remove empty-state message
         self.brush_preview_id = None
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=photo)
-        self.canvas.image = photo
-
-        self.canvas.config(scrollregion=(0, 0, zoom_w, zoom_h))
+        self.render_view()
 
         if self.preview_x is not None and self.preview_y is not None:
             class E:
@@ -411,6 +1155,191 @@ class Doodler:
             e.x, e.y = self.preview_x, self.preview_y
             self.update_brush_preview(e)
 
+    def schedule_render(self):
+        """Render the visible tiles once the event queue is idle."""
+        if self.render_pending or self.image is None:
+            return
+        self.render_pending = True
+        self.root.after_idle(self.render_view)
+
+    def render_view(self):
+        """
+        Make sure every tile intersecting the visible canvas area is on the
+        canvas, and drop the ones that scrolled out of view. Only visible
+        tiles are ever resampled and composited, so memory and latency are
+        bounded by the window size rather than the image size.
+        """
+        self.render_pending = False
+        if self.image is None:
+            return
+        start = time.perf_counter()
+
+        zoom_w = max(1, int(self.image.width * self.zoom_level))
+        zoom_h = max(1, int(self.image.height * self.zoom_level))
+        if self.render_size != (zoom_w, zoom_h):
+            for item, _ in self.tile_items.values():
+                self.canvas.delete(item)
+            self.tile_items.clear()
+            self.render_size = (zoom_w, zoom_h)
+            self.canvas.config(scrollregion=(0, 0, zoom_w, zoom_h))
+
+        visible = set(self._visible_tiles())
+
+        for key in list(self.tile_items):
+            if key not in visible:
+                item, _ = self.tile_items.pop(key)
+                self.canvas.delete(item)
+
+        new_tiles = sorted(visible - self.tile_items.keys())
+        for tx, ty in new_tiles:
+            tile = self._compose_tile(tx, ty)
+            with tracer.span("photo"):
+                photo = ImageTk.PhotoImage(tile)
+            item = self.canvas.create_image(
+                tx * TILE_SIZE, ty * TILE_SIZE, anchor=tk.NW, image=photo, tags="tile"
+            )
+            self.tile_items[(tx, ty)] = (item, photo)
+
+        if self.brush_preview_id is not None:
+            self.canvas.tag_raise(self.brush_preview_id)
+        tracer.record("render", time.perf_counter() - start, tiles=len(new_tiles))
+
+    def _visible_tiles(self):
+        """Yield (tx, ty) for the tiles intersecting the scrolled canvas view."""
+        zoom_w, zoom_h = self.render_size
+        left = max(0, int(self.canvas.canvasx(0)))
+        top = max(0, int(self.canvas.canvasy(0)))
+        right = min(zoom_w, left + max(1, self.canvas.winfo_width()))
+        bottom = min(zoom_h, top + max(1, self.canvas.winfo_height()))
+
+        for ty in range(top // TILE_SIZE, (bottom - 1) // TILE_SIZE + 1):
+            for tx in range(left // TILE_SIZE, (right - 1) // TILE_SIZE + 1):
+                yield tx, ty
+
+    def _tile_box(self, tx, ty):
+        zoom_w, zoom_h = self.render_size
+        return (
+            tx * TILE_SIZE,
+            ty * TILE_SIZE,
+            min(zoom_w, (tx + 1) * TILE_SIZE),
+            min(zoom_h, (ty + 1) * TILE_SIZE),
+        )
+
+    def _compose_tile(self, tx, ty):
+        """Alpha-composite the mask over the base image for one display tile."""
+        zoom_w, zoom_h = self.render_size
+        zx1, zy1, zx2, zy2 = self._tile_box(tx, ty)
+        base = self._base_tile(tx, ty)
+        mask = self._zoom_mask_region(zx1, zy1, zx2, zy2, zoom_w, zoom_h)
+        with tracer.span("composite"):
+            return Image.alpha_composite(base, mask)
+
+    def _build_pyramid(self, image):
+        """
+        Precompute power-of-two downsampled copies of the image.
+        Level 0 is the image itself, each further level halves both sides.
+        """
+        levels = [image]
+        with tracer.span("pyramid"):
+            while min(levels[-1].size) >= 2 * PYRAMID_MIN_SIZE:
+                levels.append(levels[-1].reduce(2))
+        return levels
+
+    def _base_tile(self, tx, ty):
+        """
+        Return one tile of the image resampled to the current display size,
+        reusing cached results. Resamples from the smallest pyramid level that
+        is still at least as large as the display size, so LANCZOS never runs
+        on more pixels than needed.
+        """
+        zoom_w, zoom_h = self.render_size
+        key = (zoom_w, zoom_h, tx, ty)
+        cached = self.tile_cache.get(key)
+        if cached is not None:
+            self.tile_cache.move_to_end(key)
+            return cached
+
+        source = self.pyramid[0]
+        for level in self.pyramid[1:]:
+            if level.width < zoom_w or level.height < zoom_h:
+                break
+            source = level
+
+        zx1, zy1, zx2, zy2 = self._tile_box(tx, ty)
+        scale_x = source.width / zoom_w
+        scale_y = source.height / zoom_h
+        box = (zx1 * scale_x, zy1 * scale_y, zx2 * scale_x, zy2 * scale_y)
+
+        # Crop with enough margin for the LANCZOS support before resizing, so
+        # the (premultiplying) resize only ever sees the pixels near the tile
+        margin = int(3 * max(scale_x, scale_y, 1.0)) + 2
+        left = max(0, int(box[0]) - margin)
+        top = max(0, int(box[1]) - margin)
+        right = min(source.width, int(np.ceil(box[2])) + margin)
+        bottom = min(source.height, int(np.ceil(box[3])) + margin)
+        with tracer.span("resize"):
+            tile = source.crop((left, top, right, bottom)).resize(
+                (zx2 - zx1, zy2 - zy1),
+                Image.Resampling.LANCZOS,
+                box=(box[0] - left, box[1] - top, box[2] - left, box[3] - top),
+            )
+
+        self.tile_cache[key] = tile
+        while len(self.tile_cache) > TILE_CACHE_SIZE:
+            self.tile_cache.popitem(last=False)
+        return tile
+
+    def refresh_region(self, x1, y1, x2, y2):
+        """
+        Re-composite only the on-screen tiles covering the image-space box
+        (x1, y1, x2, y2) and update them in place.
+        """
+        if self.render_size is None:
+            self.display_image()
+            return
+
+        zoom_w, zoom_h = self.render_size
+        scale_x = zoom_w / self.image.width
+        scale_y = zoom_h / self.image.height
+
+        # Snap the box to whole display pixels, clipped to the image
+        zx1 = max(0, int(np.floor(x1 * scale_x)))
+        zy1 = max(0, int(np.floor(y1 * scale_y)))
+        zx2 = min(zoom_w, int(np.ceil(x2 * scale_x)))
+        zy2 = min(zoom_h, int(np.ceil(y2 * scale_y)))
+        if zx2 <= zx1 or zy2 <= zy1:
+            return
+
+        start = time.perf_counter()
+        for ty in range(zy1 // TILE_SIZE, (zy2 - 1) // TILE_SIZE + 1):
+            for tx in range(zx1 // TILE_SIZE, (zx2 - 1) // TILE_SIZE + 1):
+                entry = self.tile_items.get((tx, ty))
+                if entry is not None:
+                    tile = self._compose_tile(tx, ty)
+                    with tracer.span("photo"):
+                        entry[1].paste(tile)
+        tracer.record("refresh", time.perf_counter() - start)
+
+    def _zoom_mask_region(self, zx1, zy1, zx2, zy2, zoom_w, zoom_h):
+        """
+        Nearest-neighbour zoom of the mask for the display box (zx1, zy1, zx2, zy2).
+        Uses the same pixel-centre grid for every box so neighbouring tiles
+        line up exactly.
+        """
+        mask_h, mask_w = self.mask.shape
+        cols = ((np.arange(zx1, zx2) + 0.5) * (mask_w / zoom_w)).astype(np.intp)
+        rows = ((np.arange(zy1, zy2) + 0.5) * (mask_h / zoom_h)).astype(np.intp)
+        np.minimum(cols, mask_w - 1, out=cols)
+        np.minimum(rows, mask_h - 1, out=rows)
+
+        # Only pull the labels under the box, then colour them through the palette
+        if isinstance(self.mask, TiledMask):
+            zoomed = self.mask.sample(rows, cols)
+        else:
+            src = self.mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+            zoomed = src[(rows - rows[0])[:, None], cols - cols[0]]
+        return Image.fromarray(OVERLAY_LUT[zoomed])
+
     def update_navigation_buttons(self):
         self.prev_button.config(
             state=tk.NORMAL if self.current_index > 0 else tk.DISABLED
@@ -418,11 +1347,16 @@ class Doodler:
         self.next_button.config(
             state=tk.NORMAL if self.current_index < len(self.image_files) - 1 else tk.DISABLED
         )
+        self.unlabelled_button.config(
+            state=tk.NORMAL if self.current_index >= 0 else tk.DISABLED
+        )
+        self.filmstrip.set_current(self.current_index)
 
     def next_image(self, event=None):
-        if self.has_strokes:
-            if not self.save_brush_strokes():
-                return
+        if event is not None and self._typing(event):
+            return  # a space typed into the class search
+        if not self._leave_image():
+            return
 
         if self.current_index < len(self.image_files) - 1:
             self.current_index += 1
@@ -431,84 +1365,346 @@ class Doodler:
 
     def previous_image(self, event=None):
         if self.current_index > 0:
+            self._leave_image(save=False)
             self.current_index -= 1
             self.load_image(self.image_files[self.current_index])
             self.update_navigation_buttons()
 
     # ------------------------------------------------------------------ Drawing
     def paint(self, event):
-        if self.image is None or self.mask is None:
+        """
+        Queue a motion event. Points are only collected here; they are
+        rasterised and drawn in one batch at most once per frame, so the
+        brush keeps up however many motion events the OS delivers.
+        """
+        if self.image is None or self.mask is None or self.pending_load is not None:
+            return
+        if self.tool in FILL_TOOLS:
+            self.update_brush_preview(event)
             return
 
-        x, y = event.x, event.y
-        self.preview_x, self.preview_y = x, y
+        x, y = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        if self.last_x is None or self.last_y is None:
+            # Stroke started outside the canvas (or before an image was shown)
+            self.last_x, self.last_y = x, y
+        else:
+            if not self.pending_points:
+                self.paint_queued_time = time.perf_counter()
+            self.pending_points.append((x, y))
+            self._schedule_paint()
 
-        self.pos_label.config(text=f"x={x} y={y}")
+        self.update_brush_preview(event)
 
-        if self.last_x is not None and self.last_y is not None:
-            scaled_x1 = int(self.last_x / self.zoom_level)
-            scaled_y1 = int(self.last_y / self.zoom_level)
-            scaled_x2 = int(x / self.zoom_level)
-            scaled_y2 = int(y / self.zoom_level)
+    def _schedule_paint(self):
+        if self.paint_job is not None:
+            return
+        wait = FRAME_INTERVAL_MS - (time.perf_counter() - self.last_paint_time) * 1000.0
+        if wait > 0:
+            self.paint_job = self.root.after(int(wait) + 1, self.flush_paint)
+        else:
+            self.paint_job = self.root.after_idle(self.flush_paint)
+
+    def flush_paint(self):
+        """Rasterise all queued points as one polyline and redraw the box they cover."""
+        if self.paint_job is not None:
+            self.root.after_cancel(self.paint_job)
+            self.paint_job = None
+        if not self.pending_points or self.mask is None:
+            self.pending_points = []
+            return
 
-            line_width = max(1, int(round(self.brush_size)))
-            radius = max(1, int(round(self.brush_size / 2.0)))
+        canvas_points = [(self.last_x, self.last_y)] + self.pending_points
+        self.last_x, self.last_y = self.pending_points[-1]
+        self.pending_points = []
 
-            if self.is_eraser:
-                self.draw.line(
-                    [scaled_x1, scaled_y1, scaled_x2, scaled_y2],
-                    fill=(0, 0, 0, 0),
-                    width=line_width,
-                )
-                self.draw.ellipse(
-                    [
-                        scaled_x2 - radius,
-                        scaled_y2 - radius,
-                        scaled_x2 + radius,
-                        scaled_y2 + radius,
-                    ],
-                    fill=(0, 0, 0, 0),
-                    outline=(0, 0, 0, 0),
-                )
-            else:
-                self.draw.line(
-                    [scaled_x1, scaled_y1, scaled_x2, scaled_y2],
-                    fill=self.brush_color,
-                    width=line_width,
-                )
-                self.draw.ellipse(
-                    [
-                        scaled_x2 - radius,
-                        scaled_y2 - radius,
-                        scaled_x2 + radius,
-                        scaled_y2 + radius,
-                    ],
-                    fill=self.brush_color,
-                    outline=self.brush_color,
-                )
+        points = [
+            (int(px / self.zoom_level), int(py / self.zoom_level)) for px, py in canvas_points
+        ]
+        line_width = max(1, int(round(self.brush_size)))
+        radius = max(1, int(round(self.brush_size / 2.0)))
+        value = 0 if self.is_eraser else self.brush_number
+        with tracer.span("paint", points=len(points)):
+            self._stamp_polyline(points, line_width, radius, value)
+
+        self.has_strokes = True
+        self.last_paint_time = time.perf_counter()
+        # From the oldest motion event in the batch to its pixels being on screen
+        tracer.record("paint_latency", self.last_paint_time - self.paint_queued_time)
+
+    def _stamp_polyline(self, points, line_width, radius, value):
+        """
+        Rasterise a brush polyline (round joins, and a round cap at every
+        point) straight into the label map. Only a patch the size of the
+        polyline's bounding box is drawn, and the same box is refreshed on
+        screen.
+        """
+        pad = max(line_width, 2 * radius) + 1
+        xs = [px for px, _ in points]
+        ys = [py for _, py in points]
+        left = max(0, min(xs) - pad)
+        top = max(0, min(ys) - pad)
+        right = min(self.mask.shape[1], max(xs) + pad)
+        bottom = min(self.mask.shape[0], max(ys) + pad)
+        if right <= left or bottom <= top:
+            return
 
-            self.stroke_stack.append(
-                (self.brush_color, scaled_x1, scaled_y1, scaled_x2, scaled_y2, self.brush_size)
+        if self.tool != "Superpixels":
+            self.stroke_stack.touch(left, top, right, bottom)
+        footprint = Image.new("L", (right - left, bottom - top), 0)
+        draw = ImageDraw.Draw(footprint)
+        local = [(px - left, py - top) for px, py in points]
+        if len(local) > 1:
+            draw.line(local, fill=255, width=line_width, joint="curve")
+        for px, py in local:
+            draw.ellipse(
+                [px - radius, py - radius, px + radius, py + radius],
+                fill=255,
+                outline=255,
             )
-            self.has_strokes = True
 
-        self.last_x, self.last_y = x, y
-        self.display_image()
+        if self.tool == "Superpixels":
+            self._paint_superpixels(left, top, right, bottom, np.asarray(footprint) > 0, value)
+            return
+        self._paint_patch(left, top, right, bottom, np.asarray(footprint) > 0, value)
+        self.refresh_region(left, top, right, bottom)
+
+    def _paint_patch(self, left, top, right, bottom, where, value):
+        """Set the labels of the box where the boolean array where is True."""
+        # Read, change, write back: reads of tiled masks are copies
+        patch = self.mask[top:bottom, left:right]
+        patch[where] = value
+        self.mask[top:bottom, left:right] = patch
+
+    def _paint_superpixels(self, left, top, right, bottom, footprint, value):
+        """Label every superpixel the brush footprint touches, each once per stroke."""
+        superpixels = self.superpixels
+        if superpixels is None:
+            if isinstance(self.image, TiledImage):
+                self.status_label.config(text="Superpixels are not available for tiled images.")
+            else:
+                self.status_label.config(text="Superpixels are still being computed…")
+            return
+        if self.stroke_segments is None or len(self.stroke_segments) != superpixels.count:
+            self.stroke_segments = np.zeros(superpixels.count, dtype=bool)
+        ids = superpixels.segments_in(left, top, right, bottom, footprint)
+        ids = ids[~self.stroke_segments[ids]]
+        if not len(ids):
+            return
+        self.stroke_segments[ids] = True
+        box = superpixels.box(ids)
+        self.stroke_stack.touch(*box)
+        self.mask.flat[superpixels.pixels(ids)] = value
+        self.refresh_region(*box)
+
+    def start_stroke(self, event):
+        """Everything painted until the button is released is one undo step."""
+        if self.mask is None or self.pending_load is not None:
+            return
+        self.stroke_stack.begin(self.mask)
+        if self.tool in FILL_TOOLS:
+            with tracer.span("fill", tool=self.tool):
+                self.fill_region(event)
+                self.stroke_stack.end()
+            return
+        self.last_x, self.last_y = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        self.pending_points = []
+        self.stroke_segments = None
+        if self.tool == "Superpixels":
+            # A click labels the superpixels under the brush, like a stroke of one point
+            self.pending_points = [(self.last_x, self.last_y)]
+            self.paint_queued_time = time.perf_counter()
+            self.flush_paint()
+
+    def fill_region(self, event):
+        """
+        Label the 4-connected region under the cursor with the current class
+        (or clear it with the eraser). "Fill label" grows over pixels with
+        the same mask value as the clicked one; "Fill intensity" over pixels
+        of the image within the tolerance of the clicked pixel's gray level.
+        On tiled images only the visible area around the click is searched.
+        """
+        x = int(self.canvas.canvasx(event.x) / self.zoom_level)
+        y = int(self.canvas.canvasy(event.y) / self.zoom_level)
+        height, width = self.mask.shape
+        if not (0 <= x < width and 0 <= y < height):
+            return
+        value = 0 if self.is_eraser else self.brush_number
+        tiled = isinstance(self.image, TiledImage)
+        wx1, wy1, wx2, wy2 = self._fill_window(x, y) if tiled else (0, 0, width, height)
+
+        if self.tool == "Fill label":
+            labels = self.mask[wy1:wy2, wx1:wx2]
+            seed_value = labels[y - wy1, x - wx1]
+            if seed_value == value:
+                return
+            candidates = labels == seed_value
+        else:
+            if tiled:
+                gray = np.asarray(self.image.crop((wx1, wy1, wx2, wy2)).convert("L"), dtype=np.int16)
+            else:
+                if self.gray is None:
+                    self.gray = np.asarray(self.image.convert("L"), dtype=np.int16)
+                gray = self.gray
+            try:
+                tolerance = max(0, int(self.tolerance_var.get()))
+            except (tk.TclError, ValueError):
+                tolerance = 0
+            candidates = np.abs(gray - gray[y - wy1, x - wx1]) <= tolerance
+
+        result = flood_fill(candidates, x - wx1, y - wy1)
+        if result is None:
+            return
+        left, top, right, bottom, region = result
+        left, top, right, bottom = left + wx1, top + wy1, right + wx1, bottom + wy1
+        self.stroke_stack.touch(left, top, right, bottom)
+        self._paint_patch(left, top, right, bottom, region, value)
+        self.refresh_region(left, top, right, bottom)
+        self.has_strokes = True
+        self.status_label.config(text=f"Filled {int(region.sum()):,} pixels.")
+
+    def _fill_window(self, x, y):
+        """Image box fills on tiled images search: the view, around (x, y), at most TILED_FILL_SIZE wide."""
+        height, width = self.mask.shape
+        view_x, view_y = self.canvas.canvasx(0), self.canvas.canvasy(0)
+        half = TILED_FILL_SIZE // 2
+        left = max(0, int(view_x / self.zoom_level), x - half)
+        top = max(0, int(view_y / self.zoom_level), y - half)
+        right = min(width, int((view_x + self.canvas.winfo_width()) / self.zoom_level) + 1, x + half)
+        bottom = min(height, int((view_y + self.canvas.winfo_height()) / self.zoom_level) + 1, y + half)
+        return min(left, x), min(top, y), max(right, x + 1), max(bottom, y + 1)
 
     def reset_last_coords(self, event):
+        self.flush_paint()
         self.last_x, self.last_y = None, None
+        self.stroke_stack.end()
 
-    def _on_color_combo(self, event=None):
-        name = self.selected_color.get()
-        for number, cname, hex_color in PREDEFINED_COLOURS:
-            if cname == name:
-                self.brush_number = number
-                self.brush_color = hex_color
-                break
+    def undo(self, event=None):
+        with tracer.span("undo"):
+            self._apply_history(self.stroke_stack.undo(), "Nothing to undo.")
+
+    def redo(self, event=None):
+        with tracer.span("redo"):
+            self._apply_history(self.stroke_stack.redo(), "Nothing to redo.")
+
+    def _apply_history(self, change, empty_message):
+        if change is None:
+            self.status_label.config(text=empty_message)
+            return
+        mask, box = change
+        self.has_strokes = True
+        if mask is self.mask:
+            self.refresh_region(*box)
+
+    def _on_tool_combo(self, event=None):
+        self.flush_paint()
+        self.tool = self.tool_var.get()
+        self.request_superpixels()
+
+    def request_superpixels(self):
+        """
+        Start over-segmenting the current image (or plane) in the background
+        if the superpixel tool is selected and it is not done yet. Results
+        are cached next to the images, so each file is only segmented once.
+        """
+        if self.tool != "Superpixels" or self.image is None or self.current_index < 0:
+            return
+        if isinstance(self.image, TiledImage):
+            self.superpixels = self.superpixel_key = None
+            self.status_label.config(text="Superpixels are not available for tiled images.")
+            return
+        image_path = os.path.join(self.current_folder, self.image_files[self.current_index])
+        index = self.slice_index if self.stack is not None else None
+        key = (image_path, index, self.contrast_percentiles)
+        if key == self.superpixel_key:
+            return
+
+        self.superpixels = None
+        self.superpixel_key = key
+        variant = "" if index is None else f"_plane{index}"
+        if self.contrast_percentiles:
+            variant += "_p{:g}-{:g}".format(*self.contrast_percentiles)
+        future = self.prefetch_pool.submit(load_superpixels, image_path, self.image, variant)
+        self.status_label.config(text="Computing superpixels…")
+        self.root.after(50, self._poll_superpixels, key, future)
+
+    def _poll_superpixels(self, key, future):
+        if key != self.superpixel_key:
+            return  # the image changed in the meantime
+        if not future.done():
+            self.root.after(50, self._poll_superpixels, key, future)
+            return
+        try:
+            self.superpixels = future.result()
+        except Exception as e:
+            self.superpixel_key = None
+            self.status_label.config(text=f"Failed to compute superpixels: {e}")
+            return
+        self.status_label.config(text=f"{self.superpixels.count:,} superpixels ready.")
+
+    def select_class(self, number):
+        """Paint with class number from now on."""
+        self.brush_number = number
+        self.brush_color = NUMBER_TO_COLOUR[number]
+        self.selected_color.set(self.class_labels[number])
         self.color_display.config(bg=self.brush_color)
         self.is_eraser = False
         self.eraser_var.set(False)
 
+    def _matching_classes(self, text):
+        """Class numbers whose number or name matches text, best matches first."""
+        text = text.strip().lower()
+        if not text:
+            return list(self.class_labels)
+        exact = [number for number in self.class_labels if str(number) == text]
+        return exact + [
+            number for number, label in self.class_labels.items()
+            if number not in exact and text in label.lower()
+        ]
+
+    def _filter_classes(self, event=None):
+        if event is not None and event.keysym in ("Return", "Escape", "Up", "Down", "Tab"):
+            return
+        matches = self._matching_classes(self.selected_color.get())
+        self.color_combo.configure(values=[self.class_labels[number] for number in matches])
+
+    def _on_color_combo(self, event=None):
+        text = self.selected_color.get()
+        chosen = [number for number, label in self.class_labels.items() if label == text]
+        matches = chosen or self._matching_classes(text)
+        if matches:
+            self.select_class(matches[0])
+        self._end_class_search()
+        if event is not None and event.keysym == "Return":
+            self.canvas.focus_set()
+
+    def _start_class_search(self, event=None):
+        self.color_combo.focus_set()
+        self.color_combo.select_range(0, tk.END)
+        return "break"
+
+    def _end_class_search(self, event=None):
+        """Show the current class again and list every class."""
+        self.color_combo.configure(values=list(self.class_labels.values()))
+        self.selected_color.set(self.class_labels[self.brush_number])
+        if event is not None and event.keysym == "Escape":
+            self.canvas.focus_set()
+
+    def _typing(self, event):
+        return isinstance(event.widget, (tk.Entry, tk.Spinbox, ttk.Entry, ttk.Combobox, ttk.Spinbox))
+
+    def _on_class_key(self, event):
+        """Class shortcuts (1-9 and 0 by default), unless typing in a field."""
+        number = CLASS_KEYS.get(event.char)
+        if number is not None and not self._typing(event):
+            self.select_class(number)
+
+    def _cycle_class(self, event, step):
+        if self._typing(event):
+            return
+        numbers = list(self.class_labels)
+        index = numbers.index(self.brush_number) if self.brush_number in numbers else 0
+        self.select_class(numbers[(index + step) % len(numbers)])
+
     def update_brush_size_from_slider(self, val):
         self.brush_size = float(val)
         self.brush_size_label.config(text=f"{self.brush_size:.1f}px")
@@ -525,10 +1721,48 @@ class Doodler:
             self.update_brush_preview(e)
 
     def update_zoom(self, val):
-        self.zoom_level = float(val)
-        self.zoom_label.config(text=f"{self.zoom_level:.1f}×")
+        val = float(val)
+        if val >= ZOOM_STEP:
+            zoom = round(val / ZOOM_STEP) * ZOOM_STEP
+        else:
+            # Further out (tiled images only) zoom in powers of two, like the pyramid
+            zoom = 2.0 ** np.floor(np.log2(val))
+        if abs(zoom - self.zoom_level) < 1e-9:
+            return
+        self.zoom_level = zoom
+        self.zoom_label.config(text=f"{zoom:.1f}×" if zoom >= 0.1 else f"1/{round(1 / zoom)}×")
         self.display_image()
 
+    def _update_zoom_range(self, image):
+        """
+        Tiled (gigapixel) images can be zoomed out until they fit the window,
+        and open that way; other images keep the usual zoom range.
+        """
+        low = self.min_zoom
+        if isinstance(image, TiledImage):
+            low = min(
+                low,
+                max(1, self.canvas.winfo_width()) / image.width,
+                max(1, self.canvas.winfo_height()) / image.height,
+            )
+        self.zoom_slider.configure(from_=low)
+        if isinstance(image, TiledImage) or self.zoom_level < low:
+            self.zoom_slider.set(low)
+            self.update_zoom(low)
+
+    def _update_perf_label(self):
+        """Show the rolling p50/p95 of the main stages next to the pointer position."""
+        if not tracer.enabled:
+            return
+        parts = []
+        for stage, name in PERF_HUD_STAGES:
+            stats = tracer.stats(stage)
+            if stats is not None:
+                parts.append(f"{name} {stats[0]:.0f}/{stats[1]:.0f} ms")
+        self.perf_label.config(text="  ".join(parts))
+        tracer.flush()
+        self.root.after(PERF_HUD_INTERVAL_MS, self._update_perf_label)
+
     def update_brush_preview(self, event):
         if self.image is None:
             return
@@ -539,8 +1773,10 @@ class Doodler:
         base_radius = max(1, int(round(self.brush_size / 2.0)))
         r = max(1, int(round(base_radius * self.zoom_level)))
 
-        x1, y1 = event.x - r, event.y - r
-        x2, y2 = event.x + r, event.y + r
+        # Canvas coordinates, so the preview follows the pointer when scrolled
+        cx, cy = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        x1, y1 = cx - r, cy - r
+        x2, y2 = cx + r, cy + r
 
         outline = "#ffffff" if not self.is_eraser else "#00ffff"
 
@@ -555,58 +1791,100 @@ class Doodler:
     def clear_mask(self):
         if self.image is None:
             return
-        self.mask = Image.new("RGBA", self.image.size, (0, 0, 0, 0))
-        self.draw = ImageDraw.Draw(self.mask)
-        self.stroke_stack.clear()
-        self.erased_strokes.clear()
-        self.has_strokes = False
+        if isinstance(self.mask, TiledMask):
+            # Dropping the chunks is instant, but a gigapixel undo step is not
+            self.mask.clear()
+            self.stroke_stack.clear()
+            if self.journal is not None:
+                self.save_pool.submit(self.journal.clear, self.slice_index)
+            self.has_strokes = True
+            self.display_image()
+            self.status_label.config(text="Mask cleared (this cannot be undone on tiled images).")
+            return
+        # Cleared in place (and undoable), so stacks keep pointing at this slice's mask
+        self.stroke_stack.begin(self.mask)
+        self.stroke_stack.touch(0, 0, self.mask.shape[1], self.mask.shape[0])
+        self.mask[...] = 0
+        if self.stroke_stack.end():
+            self.has_strokes = True
         self.display_image()
         self.status_label.config(text="Mask cleared.")
 
-    def save_brush_strokes(self):
+    def save_brush_strokes(self, report=False):
+        """
+        Save the mask of the shown file, in the background unless async_save
+        is off. With report, the status bar says when the background write
+        has finished, or why it failed.
+        """
+        if self.loading_file is not None:
+            # The mask still belongs to the file that was shown before
+            self.status_label.config(text=f"Wait for {os.path.basename(self.loading_file)} to open.")
+            return False
         if self.mask is None:
             messagebox.showerror("Error", "No brush strokes to save.")
             return False
 
+        fmt, preview = self.format_var.get(), self.preview_var.get()
+        if isinstance(self.mask, TiledMask):
+            # Streamed to disk chunk by chunk; the other formats need the whole map in memory
+            fmt, preview = "npy", False
         if self.image_files:
             current_image_file = self.image_files[self.current_index]
-            base_name, ext = os.path.splitext(current_image_file)
-            default_save_path_npy = os.path.join(self.current_folder, f"{base_name}_mask.npy")
-            default_save_path_png = os.path.join(self.current_folder, f"{base_name}_mask.png")
+            default_save_path_mask, default_save_path_png = mask_paths(
+                os.path.join(self.current_folder, current_image_file), fmt
+            )
         else:
-            default_save_path_npy = filedialog.asksaveasfilename(
-                defaultextension=".npy",
-                filetypes=[("NumPy files", "*.npy")],
+            extension = MASK_FORMATS[fmt]
+            default_save_path_mask = filedialog.asksaveasfilename(
+                defaultextension=extension,
+                filetypes=[(f"{fmt} masks", "*" + extension)],
             )
-            default_save_path_png = filedialog.asksaveasfilename(
+            default_save_path_png = preview and filedialog.asksaveasfilename(
                 defaultextension=".png",
                 filetypes=[("PNG files", "*.png")],
             )
 
-        if not default_save_path_npy or not default_save_path_png:
+        if not default_save_path_mask or (preview and not default_save_path_png):
             return False
+        if not preview:
+            default_save_path_png = None
+
+        start = time.perf_counter()
+        if self.stack is not None:
+            # Stacks are saved as one label volume; a single PNG can't preview that
+            mask = self.stack_labels()
+            default_save_path_png = None
+        else:
+            mask = self.mask.copy() if self.async_save else self.mask
+        write = tracer.wrap("save_write", _write_mask)
 
-        mask_array = np.array(self.mask)
-        num_array = np.zeros((mask_array.shape[0], mask_array.shape[1]), dtype=np.uint8)
-
-        for number, _, hex_color in PREDEFINED_COLOURS:
-            r, g, b = ImageColor.getrgb(hex_color)
-            color_mask = (mask_array[..., :3] == [r, g, b]).all(axis=-1)
-            num_array[color_mask] = number
-
-        background_mask = (mask_array[..., 3] == 0)
-        num_array[background_mask] = 0
+        if self.async_save:
+            # Hand a snapshot to the writer so painting can carry on right away
+            future = self.save_pool.submit(
+                write, mask, default_save_path_mask, default_save_path_png, self.journal
+            )
+            tracer.record("save", time.perf_counter() - start)
+            # The file only counts as labelled once the write has succeeded
+            labelled = (self.folder_index, current_image_file) if self.image_files else None
+            self.pending_saves.append((future, default_save_path_mask, labelled, report))
+            if len(self.pending_saves) == 1:
+                self.root.after(100, self._poll_saves)
+            self._update_save_label()
+            self.has_strokes = False
+            if self.image_files:
+                self.filmstrip.invalidate(current_image_file, after=future)
+            return True
 
         try:
-            np.save(default_save_path_npy, num_array)
-
-            black_background = Image.new("RGB", self.mask.size, (0, 0, 0))
-            rgb_mask = Image.alpha_composite(
-                black_background.convert("RGBA"), self.mask
-            ).convert("RGB")
-            rgb_mask.save(default_save_path_png)
-
-            msg = f"Saved:\n{default_save_path_npy}\n{default_save_path_png}"
+            folder_mtimes = write(mask, default_save_path_mask, default_save_path_png, self.journal)
+            self.has_strokes = False
+            if self.image_files:
+                self.folder_index.mark_labelled(current_image_file, folder_mtimes)
+                self.filmstrip.invalidate(current_image_file)
+
+            msg = f"Saved:\n{default_save_path_mask}"
+            if default_save_path_png:
+                msg += f"\n{default_save_path_png}"
             messagebox.showinfo("Saved", msg)
             self.status_label.config(text="Mask saved.")
             return True
@@ -614,6 +1892,57 @@ class Doodler:
             messagebox.showerror("Error", f"Failed to save the file:\n{e}")
             return False
 
+    def _poll_saves(self):
+        """Report finished background saves and keep the status indicator current."""
+        still_pending = []
+        for future, path, labelled, report in self.pending_saves:
+            if not future.done():
+                still_pending.append((future, path, labelled, report))
+            elif future.exception() is not None:
+                if report:
+                    self.status_label.config(text=f"Failed to save {path}: {future.exception()}")
+                messagebox.showerror(
+                    "Error", f"Failed to save the file:\n{path}\n\n{future.exception()}"
+                )
+            else:
+                if labelled is not None:
+                    index, name = labelled
+                    index.mark_labelled(name, future.result())
+                if report:
+                    self.status_label.config(text=f"Mask saved to {path}.")
+        self.pending_saves = still_pending
+        self._update_save_label()
+        if self.pending_saves:
+            self.root.after(100, self._poll_saves)
+
+    def _update_save_label(self):
+        count = len(self.pending_saves)
+        self.save_label.config(text=f"Saving {count} mask{'s' if count > 1 else ''}…" if count else "")
+
+    def flush_saves(self):
+        """Block until every queued save has been written."""
+        for future, _, _, _ in self.pending_saves:
+            future.exception()
+        self._poll_saves()
+
+    def on_close(self):
+        """Finish outstanding saves before the window goes away."""
+        if self.pending_saves:
+            self.save_label.config(text="Finishing saves…")
+            self.root.update_idletasks()
+            self.flush_saves()
+        self._close_index()
+        if self.journal is not None:
+            # Edits that were not saved stay in the journal, for the next session
+            self.save_pool.submit(self.journal.close)
+        self.save_pool.shutdown()
+        self.scan_pool.shutdown(wait=False, cancel_futures=True)
+        self.thumb_pool.shutdown(wait=False, cancel_futures=True)
+        self.prefetch_pool.shutdown(wait=False, cancel_futures=True)
+        if self.prelabel_pool is not None:
+            self.prelabel_pool.shutdown(wait=False, cancel_futures=True)
+        tracer.stop()
+        self.root.destroy()
 
 if __name__ == "__main__":
     app = Doodler()
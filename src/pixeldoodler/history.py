@@ -0,0 +1,147 @@
+import zlib
+from collections import deque
+
+import numpy as np
+
+# Side length of the label-map tiles that undo steps store deltas for
+HISTORY_TILE = 64
+
+
+class _Edit:
+    """One undo step: compressed before/after copies of the tiles it changed."""
+
+    def __init__(self, mask, tiles):
+        self.mask = mask
+        self.tiles = tiles  # [(ty, tx, before, after), ...]
+        self.nbytes = sum(len(before) + len(after) for _, _, before, after in tiles)
+
+    def contents(self, use_after):
+        """[(ty, tx, zlib data), ...] of the tiles after (or before) the edit."""
+        return [(ty, tx, after if use_after else before) for ty, tx, before, after in self.tiles]
+
+    def apply(self, use_after):
+        """Write the before (undo) or after (redo) contents back; returns the bounding box."""
+        height, width = self.mask.shape
+        x1 = y1 = float("inf")
+        x2 = y2 = 0
+        for ty, tx, data in self.contents(use_after):
+            top, left = ty * HISTORY_TILE, tx * HISTORY_TILE
+            bottom, right = min(height, top + HISTORY_TILE), min(width, left + HISTORY_TILE)
+            data = zlib.decompress(data)
+            self.mask[top:bottom, left:right] = np.frombuffer(data, dtype=self.mask.dtype).reshape(
+                bottom - top, right - left
+            )
+            x1, y1 = min(x1, left), min(y1, top)
+            x2, y2 = max(x2, right), max(y2, bottom)
+        return x1, y1, x2, y2
+
+
+class StrokeHistory:
+    """
+    Bounded undo/redo history for edits to label maps, grouped per stroke.
+
+    Call begin() when a stroke starts, touch() with the box of every region
+    about to be modified, and end() when the stroke is finished. Only the
+    tiles a stroke touched are stored (zlib-compressed, before and after),
+    so undo and redo cost O(stroke area). Once the history holds more than
+    max_bytes, the oldest steps are dropped.
+
+    If on_change is given, it is called as on_change(mask, tiles) after
+    every stroke, undo and redo, with the new contents of the tiles that
+    changed in the same form as _Edit.contents().
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, on_change=None):
+        self.max_bytes = max_bytes
+        self.on_change = on_change
+        self.undo_steps = deque()
+        self.redo_steps = []
+        self.nbytes = 0
+        self._mask = None
+        self._before = None
+
+    def __len__(self):
+        return len(self.undo_steps)
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps.clear()
+        self.nbytes = 0
+        self._mask = None
+        self._before = None
+
+    def begin(self, mask):
+        """Start grouping edits to mask into one undo step."""
+        self._mask = mask
+        self._before = {}
+
+    def touch(self, x1, y1, x2, y2):
+        """Remember the current contents of the tiles overlapping a box that is about to change."""
+        if self._before is None:
+            return
+        height, width = self._mask.shape
+        x1, y1 = max(0, int(x1)), max(0, int(y1))
+        x2, y2 = min(width, int(x2)), min(height, int(y2))
+        for ty in range(y1 // HISTORY_TILE, (y2 - 1) // HISTORY_TILE + 1):
+            for tx in range(x1 // HISTORY_TILE, (x2 - 1) // HISTORY_TILE + 1):
+                if (ty, tx) not in self._before:
+                    self._before[(ty, tx)] = self._tile(ty, tx).copy()
+
+    def end(self):
+        """Close the current group; returns True if it changed anything."""
+        if self._before is None:
+            return False
+        tiles = []
+        for (ty, tx), before in self._before.items():
+            after = self._tile(ty, tx)
+            if not np.array_equal(before, after):
+                tiles.append((ty, tx, zlib.compress(before.tobytes(), 1), zlib.compress(after.tobytes(), 1)))
+        mask = self._mask
+        self._mask = None
+        self._before = None
+        if not tiles:
+            return False
+
+        self._drop(self.redo_steps)
+        self.redo_steps = []
+        edit = _Edit(mask, tiles)
+        self._push(self.undo_steps, edit)
+        while self.nbytes > self.max_bytes and len(self.undo_steps) > 1:
+            self.nbytes -= self.undo_steps.popleft().nbytes
+        self._changed(edit, use_after=True)
+        return True
+
+    def undo(self):
+        """Revert the latest step. Returns (mask, box) of what changed, or None."""
+        if not self.undo_steps:
+            return None
+        edit = self.undo_steps.pop()
+        self.redo_steps.append(edit)
+        box = edit.apply(use_after=False)
+        self._changed(edit, use_after=False)
+        return edit.mask, box
+
+    def redo(self):
+        """Re-apply the latest undone step. Returns (mask, box) of what changed, or None."""
+        if not self.redo_steps:
+            return None
+        edit = self.redo_steps.pop()
+        self.undo_steps.append(edit)
+        box = edit.apply(use_after=True)
+        self._changed(edit, use_after=True)
+        return edit.mask, box
+
+    def _changed(self, edit, use_after):
+        if self.on_change is not None:
+            self.on_change(edit.mask, edit.contents(use_after))
+
+    def _tile(self, ty, tx):
+        top, left = ty * HISTORY_TILE, tx * HISTORY_TILE
+        return self._mask[top:top + HISTORY_TILE, left:left + HISTORY_TILE]
+
+    def _push(self, steps, edit):
+        steps.append(edit)
+        self.nbytes += edit.nbytes
+
+    def _drop(self, steps):
+        self.nbytes -= sum(edit.nbytes for edit in steps)
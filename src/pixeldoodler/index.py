@@ -0,0 +1,215 @@
+import json
+import os
+import queue
+import threading
+
+from .loaders import SIDECAR_DIR, sidecar_path
+from .masks import MASK_EXTENSIONS, MASK_SUFFIX, write_atomic
+
+# Files opened as images; <name>_mask.* files are masks, not images
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".tif", ".tiff", ".npy")
+# Name of the cached index inside the folder's sidecar directory
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+# Directory entries the scanner hands over at a time
+SCAN_BATCH = 2000
+
+
+class FolderIndex:
+    """
+    Sorted list of the images in a folder with their size, mtime and whether
+    a mask has been saved for them.
+
+    The index is cached in the folder's sidecar directory, so reopening a
+    folder is instant; if the folder has changed since, it is rescanned with
+    os.scandir on a background thread. The scanner hands entries over in
+    batches and poll() merges them on the caller's thread, so the list fills
+    in progressively instead of blocking until the whole folder is read.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.names = []  # sorted image names
+        self.files = {}  # name -> [size, mtime_ns, has_mask]
+        self.folder_mtime = None
+        self.complete = False
+        self.dirty = False
+        # What the current scan has found: image names, and base names with a mask
+        self._seen = set()
+        self._seen_masks = set()
+        self._by_base = {}  # image base name -> names, to flag masks found later
+        self._batches = queue.Queue()
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def labelled(self):
+        """Number of images that have a mask."""
+        return sum(1 for info in self.files.values() if info[2])
+
+    def has_mask(self, name):
+        info = self.files.get(name)
+        return bool(info and info[2])
+
+    def load(self):
+        """
+        Fill the index from the sidecar cache. Returns True if the cache is
+        still current (the folder has not changed since), so no scan is needed.
+        """
+        try:
+            with open(os.path.join(self.folder, SIDECAR_DIR, INDEX_FILE), encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("version") != INDEX_VERSION:
+                return False
+            self.files = {
+                name: [size, mtime_ns, bool(has_mask)]
+                for name, size, mtime_ns, has_mask in cached["files"]
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            self.files = {}
+            return False
+        self.names = sorted(self.files)
+        self.folder_mtime = cached.get("folder_mtime_ns")
+        try:
+            self.complete = self.folder_mtime == os.stat(self.folder).st_mtime_ns
+        except OSError:
+            self.complete = False
+        return self.complete
+
+    def save(self):
+        """Write the index to the sidecar cache (if the folder is writable)."""
+        if not self.complete:
+            return
+        data = {
+            "version": INDEX_VERSION,
+            "folder_mtime_ns": self.folder_mtime,
+            "files": [[name] + self.files[name] for name in self.names],
+        }
+        try:
+            path = sidecar_path(self.folder, INDEX_FILE)
+            write_atomic(path, lambda f: f.write(json.dumps(data).encode("utf-8")))
+            self.dirty = False
+        except OSError:
+            pass
+
+    def scan(self):
+        """
+        Read the folder. Runs on a worker thread: results only go into a
+        queue, to be merged by poll(). Stops early once cancel() is called.
+        """
+        try:
+            # Create the sidecar directory first: that changes the folder's mtime
+            sidecar_path(self.folder, INDEX_FILE)
+        except OSError:
+            pass
+        try:
+            folder_mtime = os.stat(self.folder).st_mtime_ns
+            images, masks = [], []
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if self._stop.is_set():
+                        return
+                    base, ext = os.path.splitext(entry.name)
+                    ext = ext.lower()
+                    if base.endswith(MASK_SUFFIX):
+                        if ext in MASK_EXTENSIONS:
+                            masks.append(base[:-len(MASK_SUFFIX)])
+                    elif ext in IMAGE_EXTENSIONS and entry.is_file():
+                        stat = entry.stat()
+                        images.append((entry.name, base, stat.st_size, stat.st_mtime_ns))
+                    if len(images) + len(masks) >= SCAN_BATCH:
+                        self._batches.put((images, masks))
+                        images, masks = [], []
+            self._batches.put((images, masks))
+            self._batches.put(folder_mtime)
+        except OSError as e:
+            self._batches.put(e)
+
+    def cancel(self):
+        self._stop.set()
+
+    def poll(self):
+        """
+        Merge everything the scanner has found so far. Returns True if the
+        list changed. Raises the OSError the scan failed with, if any.
+        """
+        changed = False
+        while True:
+            try:
+                item = self._batches.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, OSError):
+                raise item
+            if isinstance(item, tuple):
+                changed |= self._merge(*item)
+            else:
+                changed |= self._finish(item)
+        return changed
+
+    def _merge(self, images, masks):
+        count = len(self.names)
+        for base in masks:
+            self._seen_masks.add(base)
+            for name in self._by_base.get(base, ()):
+                self.files[name][2] = True
+        for name, base, size, mtime_ns in images:
+            self._seen.add(name)
+            self._by_base.setdefault(base, []).append(name)
+            info = self.files.get(name)
+            if info is None:
+                self.names.append(name)
+                self.files[name] = [size, mtime_ns, base in self._seen_masks]
+            else:
+                # keep a cached mask flag until the scan has seen all masks
+                info[:] = [size, mtime_ns, info[2] or base in self._seen_masks]
+        if len(self.names) != count:
+            # one sorted run plus a short one: sort() merges them in linear time
+            self.names.sort()
+        self.dirty = True
+        return bool(images or masks)
+
+    def _finish(self, folder_mtime):
+        """The scan is done: drop files that are gone and settle the mask flags."""
+        if len(self._seen) != len(self.names):
+            for name in self.names:
+                if name not in self._seen:
+                    del self.files[name]
+            self.names = [name for name in self.names if name in self.files]
+        # Also corrects cached flags of masks that were deleted in the meantime
+        for base, names in self._by_base.items():
+            has_mask = base in self._seen_masks
+            for name in names:
+                self.files[name][2] = has_mask
+        self.folder_mtime = folder_mtime
+        self.complete = True
+        self._seen, self._seen_masks, self._by_base = set(), set(), {}
+        self.save()
+        return True
+
+    def mark_labelled(self, name, folder_mtimes=None):
+        """
+        Record that a mask has been saved for name. folder_mtimes is the
+        folder's mtime before and after the mask was written: if nothing
+        else had changed the folder, the index stays current, so reopening
+        it does not need a scan.
+        """
+        info = self.files.get(name)
+        if info is not None and not info[2]:
+            info[2] = True
+            self._seen_masks.add(os.path.splitext(name)[0])
+            self.dirty = True
+        if folder_mtimes is not None and self.complete and folder_mtimes[0] == self.folder_mtime:
+            self.folder_mtime = folder_mtimes[1]
+            self.dirty = True
+
+    def next_unlabelled(self, index):
+        """Index of the first image after index (wrapping around) without a mask, or None."""
+        count = len(self.names)
+        for step in range(1, count + 1):
+            i = (index + step) % count
+            if not self.files[self.names[i]][2]:
+                return i
+        return None
@@ -0,0 +1,209 @@
+"""
+Opt-in timing of the Doodler's stages (decoding, resampling, compositing,
+PhotoImage creation, painting, saving...), for finding out where the time
+goes when the tool feels slow.
+
+Tracing is off unless PIXELDOODLER_TRACE is set to a file name, or the
+app is started with `pixeldoodler --trace [FILE]`. Timings then go to that
+file as JSON lines, one per timed call, and rolling statistics are shown
+in the status bar. When off, a timed block costs one method call.
+"""
+import json
+import os
+import platform
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import nullcontext
+
+import numpy as np
+
+# Environment variable naming the trace file
+TRACE_ENV = "PIXELDOODLER_TRACE"
+# Trace file used by `pixeldoodler --trace` without a file name
+DEFAULT_TRACE_FILE = "pixeldoodler-trace.jsonl"
+# Durations kept per stage for the rolling statistics
+STATS_WINDOW = 240
+# Records buffered before they are written to the trace file
+TRACE_BUFFER = 256
+
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("tracer", "stage", "fields", "start")
+
+    def __init__(self, tracer, stage, fields):
+        self.tracer = tracer
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.stage, time.perf_counter() - self.start, **self.fields)
+        return False
+
+
+class Tracer:
+    """
+    Collects stage timings from any thread. Use `with tracer.span(stage):`
+    around a block, tracer.record() for durations measured elsewhere (e.g.
+    from an event to its redraw) and tracer.wrap() for functions handed to
+    worker threads.
+
+    Each record is a JSON object with the wall-clock time, a session id, the
+    stage, its duration in milliseconds, the thread, and any extra fields.
+    The first record of a session describes the machine, so trace files
+    from different users can be concatenated and aggregated.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.session = None
+        self._recent = defaultdict(lambda: deque(maxlen=STATS_WINDOW))
+        self._buffer = []
+        self._file = None
+        self._lock = threading.Lock()
+
+    def start(self, path):
+        """Start tracing, appending to the file at path."""
+        if self.enabled:
+            return
+        self._file = open(path, "a", encoding="utf-8")
+        self.path = path
+        self.session = uuid.uuid4().hex[:12]
+        self.enabled = True
+        try:
+            from importlib.metadata import version
+
+            pixeldoodler_version = version("pixeldoodler")
+        except Exception:
+            pixeldoodler_version = None
+        self.event(
+            "session",
+            version=pixeldoodler_version,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=os.cpu_count(),
+        )
+
+    def stop(self):
+        """Write out what is buffered and stop tracing."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        with self._lock:
+            self._flush_locked()
+            self._file.close()
+            self._file = None
+
+    def span(self, stage, **fields):
+        """Context manager timing the block inside it as one call of stage."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage, fields)
+
+    def wrap(self, stage, func):
+        """func, timed as stage whenever it is called (on whatever thread)."""
+        if not self.enabled:
+            return func
+
+        def timed(*args, **kwargs):
+            with self.span(stage):
+                return func(*args, **kwargs)
+        return timed
+
+    def record(self, stage, seconds, **fields):
+        """Add one call of stage that took seconds."""
+        if not self.enabled:
+            return
+        entry = {
+            "t": round(time.time(), 6),
+            "session": self.session,
+            "stage": stage,
+            "ms": round(seconds * 1000.0, 3),
+            "thread": threading.current_thread().name,
+        }
+        entry.update(fields)
+        with self._lock:
+            self._recent[stage].append(seconds)
+            self._buffer.append(entry)
+            if len(self._buffer) >= TRACE_BUFFER:
+                self._flush_locked()
+
+    def event(self, name, **fields):
+        """Add a record that is not a timing (session start, file opened...)."""
+        if not self.enabled:
+            return
+        entry = {"t": round(time.time(), 6), "session": self.session, "event": name}
+        entry.update(fields)
+        with self._lock:
+            self._buffer.append(entry)
+
+    def stats(self, stage):
+        """(p50, p95) in milliseconds over the latest calls of stage, or None."""
+        with self._lock:
+            recent = self._recent.get(stage)
+            if not recent:
+                return None
+            samples = np.fromiter(recent, dtype=np.float64, count=len(recent))
+        p50, p95 = np.percentile(samples, (50, 95)) * 1000.0
+        return p50, p95
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._buffer and self._file is not None:
+            self._file.write("".join(json.dumps(entry) + "\n" for entry in self._buffer))
+            self._file.flush()
+        self._buffer = []
+
+
+# The tracer the app reports to
+tracer = Tracer()
+
+
+def start_from_environment():
+    """Start tracing if PIXELDOODLER_TRACE names a file."""
+    path = os.environ.get(TRACE_ENV)
+    if path and not tracer.enabled:
+        tracer.start(path)
+
+
+def summarize_traces(paths):
+    """
+    Per-stage statistics over trace files (from any number of sessions):
+    {stage: {"n", "sessions", "p50", "p95", "p99", "max"}} in milliseconds.
+    """
+    durations = defaultdict(list)
+    sessions = defaultdict(set)
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                if "stage" in entry:
+                    durations[entry["stage"]].append(entry["ms"])
+                    sessions[entry["stage"]].add(entry.get("session"))
+    summary = {}
+    for stage, values in sorted(durations.items()):
+        values = np.asarray(values, dtype=np.float64)
+        p50, p95, p99 = np.percentile(values, (50, 95, 99))
+        summary[stage] = {
+            "n": int(len(values)),
+            "sessions": len(sessions[stage]),
+            "p50": round(float(p50), 3),
+            "p95": round(float(p95), 3),
+            "p99": round(float(p99), 3),
+            "max": round(float(values.max()), 3),
+        }
+    return summary
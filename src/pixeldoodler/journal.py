@@ -0,0 +1,180 @@
+"""
+Crash-safe journal of unsaved mask edits.
+
+Every stroke (and undo/redo) appends the compressed label-map tiles it
+changed to <folder>/.pixeldoodler/journal/<image name>.journal, so a crash
+loses at most the stroke being drawn. Records carry a checksum and are
+fsynced; a record cut short by a crash is ignored on reading. Once the file
+grows past JOURNAL_COMPACT_BYTES it is rewritten with only the latest copy
+of every tile. Saving the mask discards the journal.
+
+Journal methods do file I/O and are meant to run on a background writer.
+"""
+import json
+import os
+import struct
+import zlib
+
+from .loaders import SIDECAR_DIR
+from .masks import write_atomic
+
+JOURNAL_MAGIC = b"PDJ1"
+# Rewrite the journal with only the latest copy of each tile past this size
+JOURNAL_COMPACT_BYTES = 16 * 1024 * 1024
+# kind, plane, tile row, tile column, payload size, payload crc32
+_RECORD = struct.Struct("<4sIIIII")
+TILE_RECORD = b"TILE"
+CLEAR_RECORD = b"CLR!"
+
+
+def journal_path(image_path):
+    folder, name = os.path.split(os.path.abspath(image_path))
+    return os.path.join(folder, SIDECAR_DIR, "journal", name + ".journal")
+
+
+def _header(shape, dtype, tile):
+    data = json.dumps({"shape": list(shape), "dtype": str(dtype), "tile": tile}).encode("utf-8")
+    return JOURNAL_MAGIC + struct.pack("<I", len(data)) + data
+
+
+def _record(kind, plane, ty=0, tx=0, data=b""):
+    return _RECORD.pack(kind, plane, ty, tx, len(data), zlib.crc32(data)) + data
+
+
+def read_journal(image_path):
+    """
+    The journal left for image_path as (header, records), or None if there
+    is none. header has the "shape" (planes, height, width), "dtype" and
+    "tile" size; records are (kind, plane, ty, tx, data) in the order they
+    were written, with data the zlib-compressed tile.
+    """
+    try:
+        with open(journal_path(image_path), "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    if content[:4] != JOURNAL_MAGIC or len(content) < 8:
+        return None
+    (size,) = struct.unpack_from("<I", content, 4)
+    try:
+        header = json.loads(content[8:8 + size])
+    except ValueError:
+        return None
+
+    records = []
+    pos = 8 + size
+    while pos + _RECORD.size <= len(content):
+        kind, plane, ty, tx, length, crc = _RECORD.unpack_from(content, pos)
+        data = content[pos + _RECORD.size:pos + _RECORD.size + length]
+        if kind not in (TILE_RECORD, CLEAR_RECORD) or len(data) != length or zlib.crc32(data) != crc:
+            break  # the end of a write interrupted by a crash
+        records.append((kind, plane, ty, tx, data))
+        pos += _RECORD.size + length
+    return header, records
+
+
+def header_matches(header, shape, dtype, tile):
+    """Whether a journal header was written for label maps of this shape, dtype and tile size."""
+    return (
+        isinstance(header, dict)
+        and header.get("shape") == list(shape)
+        and header.get("dtype") == str(dtype)
+        and header.get("tile") == tile
+    )
+
+
+def compact_records(records):
+    """The records with superseded tiles dropped; replaying them gives the same result."""
+    clears = {}
+    tiles = {}
+    for record in records:
+        kind, plane = record[:2]
+        if kind == CLEAR_RECORD:
+            clears[plane] = record
+            tiles = {key: tile for key, tile in tiles.items() if key[0] != plane}
+        else:
+            tiles[(plane, record[2], record[3])] = record
+    return list(clears.values()) + list(tiles.values())
+
+
+class Journal:
+    """
+    Append-only journal of one image's unsaved edits. shape is
+    (planes, height, width) of its label maps, tile the side length of the
+    tiles records are made of. The file is created by the first record.
+    """
+
+    def __init__(self, image_path, shape, dtype, tile):
+        self.path = journal_path(image_path)
+        self.image_path = image_path
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.tile = tile
+        self.nbytes = 0
+        self.error = None  # the OSError that stopped journalling, if any
+        self._file = None
+
+    def append(self, plane, tiles):
+        """Add the new contents of tiles ([(ty, tx, zlib data), ...]) of a plane."""
+        self._write(b"".join(_record(TILE_RECORD, plane, ty, tx, data) for ty, tx, data in tiles))
+
+    def clear(self, plane):
+        """Record that the whole plane was set to background."""
+        self._write(_record(CLEAR_RECORD, plane))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """Delete the journal, e.g. once everything in it has been saved."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.nbytes = 0
+
+    def _write(self, data):
+        if self.error is not None:
+            return
+        try:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                existing = read_journal(self.image_path)
+                if existing is not None and header_matches(existing[0], self.shape, self.dtype, self.tile):
+                    # Edits recovered from an earlier session stay in the journal until saved
+                    self._rewrite(existing[1])
+                else:
+                    self._rewrite([])
+                self._file = open(self.path, "ab")
+                self.nbytes = self._file.tell()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.nbytes += len(data)
+            if self.nbytes > JOURNAL_COMPACT_BYTES:
+                self.compact()
+        except OSError as e:
+            # e.g. a read-only folder: carry on without a journal
+            self.error = e
+            self.close()
+
+    def compact(self):
+        """Rewrite the journal with only the latest copy of every tile."""
+        self.close()
+        journal = read_journal(self.image_path)
+        self._rewrite(compact_records(journal[1]) if journal else [])
+        self._file = open(self.path, "ab")
+        self.nbytes = self._file.tell()
+
+    def _rewrite(self, records):
+        def write(f):
+            f.write(_header(self.shape, self.dtype, self.tile))
+            for record in records:
+                f.write(_record(*record))
+            f.flush()
+            os.fsync(f.fileno())
+
+        write_atomic(self.path, write)
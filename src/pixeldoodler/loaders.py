@@ -0,0 +1,302 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# Upper bound on how many array elements are converted at once. Small enough
+# for a block to stay in cache between the fused min/max/scale steps, and so
+# large (memory-mapped) arrays never get a full-size float32 copy
+CHUNK_ELEMENTS = 1 << 18
+# Percentiles of float data are estimated from at most this many samples
+PERCENTILE_SAMPLES = 1 << 20
+# Display ranges remembered per file, see cached_value_range
+RANGE_CACHE_SIZE = 4096
+# File hashes remembered per file (path, mtime and size), see file_digest
+DIGEST_CACHE_SIZE = 4096
+# Hidden folder, inside an image folder, holding data derived from its files
+SIDECAR_DIR = ".pixeldoodler"
+
+_range_cache = OrderedDict()
+_range_cache_lock = threading.Lock()
+_digest_cache = OrderedDict()
+_digest_cache_lock = threading.Lock()
+
+
+def _row_chunks(arr, elements=CHUNK_ELEMENTS):
+    """Yield slices along the first axis covering about `elements` elements each."""
+    row_size = max(1, int(np.prod(arr.shape[1:], dtype=np.int64)))
+    step = max(1, elements // row_size)
+    for start in range(0, arr.shape[0], step):
+        yield slice(start, min(arr.shape[0], start + step))
+
+
+def _lut_view(arr):
+    """
+    Unsigned view of 8/16-bit integer data, so it can index a lookup table,
+    together with the value each table index stands for. None for other data.
+    """
+    if arr.dtype.kind not in "ui" or arr.dtype.itemsize > 2 or not arr.dtype.isnative:
+        return None, None
+    index_type = np.uint8 if arr.dtype.itemsize == 1 else np.uint16
+    values = np.arange(np.iinfo(index_type).max + 1, dtype=index_type).view(arr.dtype)
+    return arr.view(index_type), values.astype(np.float64)
+
+
+def value_range(arr, percentiles=None):
+    """
+    Range of values to map onto 0-255 for display: the min/max, or the
+    given (low, high) percentiles to clip outliers. Min/max come from one
+    block-by-block scan. For percentiles, 8/16-bit integer data is
+    histogrammed in one pass, which gives exact values; other data is
+    estimated from a subsample taken during the scan.
+    """
+    if arr.dtype == bool:
+        return 0, 1
+
+    view, values = _lut_view(arr) if percentiles else (None, None)
+    if view is not None:
+        hist = np.zeros(len(values), dtype=np.int64)
+        for rows in _row_chunks(view, 16 * CHUNK_ELEMENTS):
+            hist += np.bincount(view[rows].ravel(), minlength=len(values))
+        order = np.argsort(values, kind="stable")
+        cumulative = np.cumsum(hist[order])
+        # first value whose cumulative count reaches each percentile
+        targets = [max(1, np.ceil(cumulative[-1] * p / 100.0)) for p in percentiles]
+        lo_idx, hi_idx = np.searchsorted(cumulative, targets)
+        return values[order][lo_idx], values[order][min(hi_idx, len(order) - 1)]
+
+    step = max(1, int(arr.size // PERCENTILE_SAMPLES))
+    min_val, max_val, samples = None, None, []
+    for rows in _row_chunks(arr):
+        block = arr[rows]
+        block_min, block_max = block.min(), block.max()
+        min_val = block_min if min_val is None else min(min_val, block_min)
+        max_val = block_max if max_val is None else max(max_val, block_max)
+        if percentiles:
+            samples.append(block.ravel()[::step])
+    if percentiles:
+        return tuple(np.percentile(np.concatenate(samples), percentiles))
+    return min_val, max_val
+
+
+def cached_value_range(key, arr, percentiles=None):
+    """
+    value_range, remembered under key (e.g. path, mtime and size of the
+    file) so the statistics are only computed once per file.
+    """
+    if key is None:
+        return value_range(arr, percentiles)
+    key = key + (tuple(percentiles) if percentiles else None,)
+    with _range_cache_lock:
+        if key in _range_cache:
+            _range_cache.move_to_end(key)
+            return _range_cache[key]
+    result = value_range(arr, percentiles)
+    with _range_cache_lock:
+        _range_cache[key] = result
+        while len(_range_cache) > RANGE_CACHE_SIZE:
+            _range_cache.popitem(last=False)
+    return result
+
+
+def file_key(path):
+    """Identity of a file's contents for caching: path, mtime and size."""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    Hash of a file's bytes, for caches that must survive renames and copies.
+    Remembered per file_key, so a file is only read again once it changes.
+    """
+    key = file_key(path)
+    with _digest_cache_lock:
+        if key in _digest_cache:
+            _digest_cache.move_to_end(key)
+            return _digest_cache[key]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    result = digest.hexdigest()
+    with _digest_cache_lock:
+        _digest_cache[key] = result
+        while len(_digest_cache) > DIGEST_CACHE_SIZE:
+            _digest_cache.popitem(last=False)
+    return result
+
+
+def sidecar_path(folder, *parts):
+    """Path inside the folder's sidecar directory, creating the directories it needs."""
+    path = os.path.join(folder, SIDECAR_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def to_uint8(arr, min_val, max_val, eps=0.0):
+    """
+    Linearly map [min_val, max_val] onto 0-255 into a new uint8 array,
+    clipping values outside the range. Booleans become 0/255; if the range
+    is empty the values are only clipped.
+
+    8/16-bit integers go through a lookup table (one gather pass, no float
+    temporary). Everything else is scaled block by block in a reused
+    float32 buffer.
+    """
+    out = np.empty(arr.shape, dtype=np.uint8)
+    if arr.dtype == bool:
+        for rows in _row_chunks(arr):
+            np.multiply(arr[rows], 255, out=out[rows], dtype=np.uint8)
+        return out
+
+    span = float(max_val) - float(min_val) + eps
+    scale = 255.0 / span if span > 0 else 1.0
+    offset = float(min_val) if span > 0 else 0.0
+
+    view, values = _lut_view(arr)
+    if view is not None:
+        lut = np.clip((values - offset) * scale, 0, 255).astype(np.uint8)
+        for rows in _row_chunks(view):
+            np.take(lut, view[rows], out=out[rows])
+        return out
+
+    buffer = None
+    for rows in _row_chunks(arr):
+        block = arr[rows]
+        if buffer is None or buffer.shape != block.shape:
+            buffer = np.empty(block.shape, dtype=np.float32)
+        np.subtract(block, offset, out=buffer, casting="unsafe")
+        buffer *= scale
+        np.clip(buffer, 0, 255, out=buffer)
+        out[rows] = buffer
+    return out
+
+
+def is_stack(arr):
+    """
+    True when an array holds several planes rather than one image:
+    anything beyond 2D that is not a single (H, W, C) / (C, H, W) image.
+    """
+    if arr.ndim <= 2:
+        return False
+    if arr.ndim == 3:
+        return arr.shape[2] not in (1, 3, 4) and arr.shape[0] not in (1, 3, 4)
+    return True
+
+
+class NpyStack:
+    """
+    A (Z, H, W), (T, C, H, W), ... array viewed as a flat sequence of 2D
+    planes. Trailing colour channels of size 3 or 4 are kept with each plane.
+    Planes are read on demand, so memory-mapped stacks are never loaded whole.
+    """
+
+    def __init__(self, array, percentiles=None, cache_key=None):
+        self.array = array
+        self.percentiles = percentiles
+        self.cache_key = cache_key
+        plane_dims = 3 if array.ndim >= 4 and array.shape[-1] in (3, 4) else 2
+        self.index_shape = array.shape[:-plane_dims]
+        self.plane_shape = array.shape[-plane_dims:]
+        self.planes = array.reshape((-1,) + self.plane_shape)
+        self.num_planes = self.planes.shape[0]
+        self._range = None
+
+    @property
+    def height(self):
+        return self.plane_shape[0]
+
+    @property
+    def width(self):
+        return self.plane_shape[1]
+
+    def value_range(self):
+        """Display range over the whole stack, so every plane shares one contrast."""
+        if self._range is None:
+            self._range = cached_value_range(self.cache_key, self.planes, self.percentiles)
+        return self._range
+
+    def set_percentiles(self, percentiles):
+        self.percentiles = percentiles
+        self._range = None
+
+    def plane_image(self, index):
+        """Pillow RGBA image of one plane."""
+        plane = self.planes[index]
+        if plane.ndim == 3 and plane.dtype == np.uint8:
+            plane = np.ascontiguousarray(plane)
+        else:
+            plane = to_uint8(plane, *self.value_range())
+        img = Image.fromarray(plane)
+        return img if img.mode == "RGBA" else img.convert("RGBA")
+
+    def plane_label(self, index):
+        """Human readable position of a plane, e.g. '3/40' or '(2, 5)'."""
+        if len(self.index_shape) == 1:
+            return f"{index + 1}/{self.num_planes}"
+        return str(tuple(int(i) for i in np.unravel_index(index, self.index_shape)))
+
+
+def npy_to_image(array, percentiles=None, cache_key=None):
+    """
+    Convert a numpy array to a Pillow RGBA image for display.
+    Handles:
+    - 2D arrays -> grayscale
+    - 3D arrays with channels last (H, W, C)
+    - stacks (see NpyStack) -> their first plane
+
+    Memory-mapped arrays are only read block by block, and only the part
+    that ends up on screen is converted. Values are stretched over their
+    min/max, or clipped to the given (low, high) percentiles; pass a
+    cache_key (see file_key) to compute those statistics only once.
+    """
+    arr = np.asanyarray(array)
+
+    if arr.ndim == 3:
+        if arr.shape[0] in (1, 3, 4) and arr.shape[2] not in (1, 3, 4):
+            arr = np.transpose(arr, (1, 2, 0))
+
+        if arr.shape[2] == 1:
+            arr = arr[:, :, 0]
+
+    if arr.ndim == 2:
+        # normalize to 0-255 if not already
+        arr = to_uint8(arr, *cached_value_range(cache_key, arr, percentiles))
+        return Image.fromarray(arr).convert("RGBA")
+
+    if arr.ndim == 3 and arr.shape[2] in (3, 4):
+        if arr.dtype != np.uint8:
+            arr = to_uint8(arr, *cached_value_range(cache_key, arr, percentiles))
+
+        img = Image.fromarray(np.ascontiguousarray(arr))
+        if img.mode == "RGB":
+            img = img.convert("RGBA")
+        return img
+
+    return NpyStack(arr, percentiles, cache_key).plane_image(0)
+
+
+def read_image(image_path, percentiles=None, draft_size=None):
+    """
+    Read an image file or .npy array from disk as a Pillow RGBA image.
+    Safe to call from worker threads: it never touches Tk.
+    16-bit and float images are normalised like .npy arrays instead of
+    being clipped at 255 by Pillow's RGBA conversion.
+
+    With a draft_size (width, height), formats that can (JPEG) are decoded
+    at a reduced scale that is still at least that big.
+    """
+    if image_path.lower().endswith(".npy"):
+        return npy_to_image(
+            np.load(image_path, mmap_mode="r"), percentiles, file_key(image_path)
+        )
+    with Image.open(image_path) as img:
+        if draft_size:
+            img.draft(None, draft_size)
+        if img.mode in ("I", "F") or img.mode.startswith("I;16"):
+            return npy_to_image(np.asarray(img), percentiles, file_key(image_path))
+        return img.convert("RGBA")
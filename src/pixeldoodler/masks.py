@@ -0,0 +1,388 @@
+import colorsys
+import functools
+import json
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image, ImageColor
+
+# Classes used when no class file is configured
+DEFAULT_CLASSES = [
+    (1, "Red",    "#ff0000"),
+    (2, "Blue",   "#0000ff"),
+    (3, "Green",  "#00ff00"),
+    (4, "Yellow", "#ffff00"),
+    (5, "Purple", "#800080"),
+]
+# The class file is named by this environment variable, else looked for here
+CLASSES_ENV = "PIXELDOODLER_CLASSES"
+DEFAULT_CLASSES_FILE = os.path.join(os.path.expanduser("~"), ".config", "pixeldoodler", "classes.json")
+# Largest class number a label map can hold
+MAX_CLASS = 65535
+
+
+def _generated_colour(index):
+    """A colour for the index-th class without one: hues spaced by the golden angle."""
+    hue = (index * 0.618033988749895) % 1.0
+    lightness = (0.45, 0.6, 0.35)[index % 3]
+    r, g, b = colorsys.hls_to_rgb(hue, lightness, 0.9)
+    return "#{:02x}{:02x}{:02x}".format(round(r * 255), round(g * 255), round(b * 255))
+
+
+def load_classes(path):
+    """
+    Read a class list from a JSON file: a list of classes, or an object with
+    a "classes" list. A class is a name, or an object with "name" and
+    optionally "number" (default: one more than the previous), "colour" (any
+    colour Pillow understands; default: generated) and "key" (a keyboard
+    shortcut). Returns ([(number, name, hex colour), ...], {key: number}).
+    Raises ValueError if numbers or colours are invalid or repeated.
+    """
+    with open(path, encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+    entries = data.get("classes") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path}: expected a list of classes")
+
+    classes, keys = [], {}
+    numbers, colours = set(), set()
+    number = 0
+    for index, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"name": entry}
+        elif not isinstance(entry, dict):
+            raise ValueError(f"{path}: class {index + 1} is neither a name nor an object")
+        try:
+            number = int(entry.get("number", number + 1))
+        except (TypeError, ValueError):
+            raise ValueError(f"{path}: class {index + 1} has an invalid number") from None
+        name = str(entry.get("name", number))
+        try:
+            rgb = ImageColor.getrgb(entry.get("colour") or entry.get("color") or _generated_colour(index))[:3]
+        except ValueError:
+            raise ValueError(f"{path}: class {name!r} has an invalid colour") from None
+        colour = "#{:02x}{:02x}{:02x}".format(*rgb)
+        if not 1 <= number <= MAX_CLASS:
+            raise ValueError(f"{path}: class {name!r} has number {number}, outside 1-{MAX_CLASS}")
+        if number in numbers:
+            raise ValueError(f"{path}: class number {number} is used twice")
+        if colour in colours or colour == "#000000":
+            # colour masks are decoded by colour, and black is background
+            raise ValueError(f"{path}: class {name!r} needs a colour of its own (not {colour})")
+        numbers.add(number)
+        colours.add(colour)
+        classes.append((number, name, colour))
+        if entry.get("key"):
+            keys[str(entry["key"])] = number
+    return classes, keys
+
+
+def _configured_classes():
+    """
+    The configured classes and their keys, and the error that stopped the
+    class file from being read (None if it was fine). Importing this module
+    must not fail, so a bad file falls back to DEFAULT_CLASSES; the entry
+    points report the error instead.
+    """
+    path = os.environ.get(CLASSES_ENV)
+    if not path and os.path.exists(DEFAULT_CLASSES_FILE):
+        path = DEFAULT_CLASSES_FILE
+    error = None
+    try:
+        classes, file_keys = load_classes(path) if path else (DEFAULT_CLASSES, {})
+    except (OSError, ValueError) as e:
+        error = str(e)
+        classes, file_keys = DEFAULT_CLASSES, {}
+    # 1-9 and 0 pick the first ten classes, unless the file gives those keys to others
+    keys = {str((index + 1) % 10): number for index, (number, _, _) in enumerate(classes[:10])}
+    keys.update(file_keys)
+    return classes, keys, error
+
+
+# Class numbers, names and colours, and the keys that pick them
+PREDEFINED_COLOURS, CLASS_KEYS, CLASSES_ERROR = _configured_classes()
+
+COLOUR_TO_NUMBER = {hex_color: number for number, name, hex_color in PREDEFINED_COLOURS}
+NUMBER_TO_COLOUR = {number: hex_color for number, name, hex_color in PREDEFINED_COLOURS}
+
+# Label maps are uint8 unless class numbers need more room
+MASK_DTYPE = np.uint8 if max(NUMBER_TO_COLOUR) <= 255 else np.uint16
+
+# Masks are saved beside their image as <name>_mask.<ext> (+ a <name>_mask.png preview)
+MASK_SUFFIX = "_mask"
+# Formats a label map can be saved in, and their extensions:
+#   npy  - plain array
+#   npz  - zlib-compressed array
+#   rle  - JSON run-length encoding of the whole label map (row-major)
+#   coco - COCO-style JSON with one uncompressed RLE (column-major) per class
+MASK_FORMATS = {"npy": ".npy", "npz": ".npz", "rle": ".rle", "coco": ".json"}
+MASK_EXTENSIONS = tuple(MASK_FORMATS.values()) + (".png",)
+# Saved label maps bigger than this are memory-mapped (copy-on-write) when reopened
+MASK_MMAP_BYTES = 64 * 1024 * 1024
+
+
+def _build_overlay_lut():
+    """RGBA colour for every value of MASK_DTYPE; 0 (background) stays transparent."""
+    lut = np.zeros((np.iinfo(MASK_DTYPE).max + 1, 4), dtype=np.uint8)
+    for number, hex_color in NUMBER_TO_COLOUR.items():
+        lut[number, :3] = ImageColor.getrgb(hex_color)
+        lut[number, 3] = 255
+    return lut
+
+
+OVERLAY_LUT = _build_overlay_lut()
+
+
+def mask_preview(mask):
+    """
+    Colour image of a label map for the PNG preview: a palette image
+    when class numbers fit in 8 bits, RGB otherwise.
+    """
+    if mask.dtype == np.uint8:
+        preview = Image.fromarray(mask)
+        preview.putpalette(OVERLAY_LUT[:256, :3].tobytes())
+        return preview
+    return Image.fromarray(OVERLAY_LUT[mask][..., :3])
+
+
+@functools.lru_cache(maxsize=1)
+def _colour_lut():
+    """Class number of every 24-bit colour (0 for colours of no class), made on first use."""
+    lut = np.zeros(1 << 24, dtype=MASK_DTYPE)
+    for number, _, hex_color in PREDEFINED_COLOURS:
+        r, g, b = ImageColor.getrgb(hex_color)[:3]
+        lut[(r << 16) | (g << 8) | b] = number
+    return lut
+
+
+def rgb_to_labels(rgb):
+    """
+    Recover class numbers from an (H, W, 3) colour mask. Pixels whose
+    colour is not one of the class colours become background (0).
+    One table lookup per pixel, however many classes there are.
+    """
+    rgb = np.asarray(rgb)
+    lut = _colour_lut()
+    labels = np.empty(rgb.shape[:2], dtype=MASK_DTYPE)
+    rows = max(1, (1 << 20) // max(1, rgb.shape[1]))
+    for top in range(0, rgb.shape[0], rows):
+        block = rgb[top:top + rows]
+        key = block[..., 0].astype(np.uint32) << 16
+        key |= block[..., 1].astype(np.uint32) << 8
+        key |= block[..., 2]
+        labels[top:top + rows] = lut[key]
+    return labels
+
+
+def image_to_labels(image):
+    """
+    Class numbers of a colour mask image such as a saved *_mask.png.
+    Palette images are decoded through their palette, so only the palette
+    entries (not every pixel) are matched against the class colours.
+    Fully transparent pixels count as background.
+    """
+    if image.mode == "P" and "transparency" not in image.info:
+        palette = np.asarray(image.getpalette("RGB"), dtype=np.uint8).reshape(-1, 3)
+        palette = np.vstack([palette, np.zeros((256 - len(palette), 3), dtype=np.uint8)])
+        return rgb_to_labels(palette[None, :, :])[0][np.asarray(image)]
+
+    rgba = np.asarray(image.convert("RGBA"))
+    labels = rgb_to_labels(rgba)
+    labels[rgba[..., 3] == 0] = 0
+    return labels
+
+
+def write_atomic(path, write):
+    """
+    Call write(file) on a temporary file next to path, then rename it into
+    place, so readers never see a half-written file.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def encode_runs(labels):
+    """
+    Run-length encode a label map in row-major order. Returns (values,
+    lengths): the value of each run and how many pixels it covers.
+    """
+    flat = labels.ravel()
+    if not flat.size:
+        return flat[:0], np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    return flat[starts], np.diff(np.append(starts, flat.size))
+
+
+def decode_runs(values, lengths, shape):
+    return np.repeat(np.asarray(values, dtype=MASK_DTYPE), lengths).reshape(shape)
+
+
+def _coco_counts(starts, ends, total):
+    """
+    COCO RLE counts (alternating background/foreground lengths, starting
+    with background) of a class, from the (start, end) of its runs in the
+    run-length encoding of the whole label map. Neighbouring runs never
+    share a value, so this works on the runs alone, without another pass
+    over the pixels.
+    """
+    bounds = np.column_stack([starts, ends]).ravel()
+    counts = np.diff(np.concatenate(([0], bounds, [total])))
+    return counts[:-1] if counts[-1] == 0 else counts
+
+
+def to_coco(labels):
+    """COCO-style description of a label map (or of each plane of a volume), one RLE per class."""
+    height, width = labels.shape[-2:]
+    names = {number: name for number, name, _ in PREDEFINED_COLOURS}
+    planes = labels.reshape((-1, height, width))
+    annotations = []
+    for plane_index, plane in enumerate(planes):
+        # COCO runs go down the columns
+        values, lengths = encode_runs(plane.T)
+        ends = np.cumsum(lengths)
+        # Group the runs by class once (in order), rather than scanning them per class
+        order = np.argsort(values, kind="stable")
+        numbers, firsts = np.unique(values[order], return_index=True)
+        for number, runs in zip(numbers, np.split(order, firsts[1:])):
+            if number == 0:
+                continue
+            run_ends = ends[runs]
+            annotation = {
+                "category_id": int(number),
+                "segmentation": {
+                    "size": [height, width],
+                    "counts": _coco_counts(run_ends - lengths[runs], run_ends, height * width).tolist(),
+                },
+                "area": int(lengths[runs].sum()),
+            }
+            if labels.ndim > 2:
+                annotation["plane"] = plane_index
+            annotations.append(annotation)
+    return {
+        "shape": list(labels.shape),
+        "categories": [{"id": number, "name": name} for number, name in sorted(names.items())],
+        "annotations": annotations,
+    }
+
+
+def from_coco(data):
+    shape = tuple(data["shape"])
+    height, width = shape[-2:]
+    planes = np.zeros((int(np.prod(shape[:-2], dtype=np.int64)), width * height), dtype=MASK_DTYPE)
+    for annotation in data["annotations"]:
+        counts = annotation["segmentation"]["counts"]
+        inside = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
+        plane = planes[annotation.get("plane", 0)]
+        plane[:len(inside)][inside] = annotation["category_id"]
+    # stored column-major
+    return planes.reshape((-1, width, height)).transpose(0, 2, 1).reshape(shape)
+
+
+def _write_labels(f, mask, ext):
+    if hasattr(mask, "write_npy"):
+        # chunked masks of gigapixel images (tiled.TiledMask) are streamed out
+        if ext != ".npy":
+            raise ValueError("masks of tiled images can only be saved as .npy")
+        mask.write_npy(f)
+    elif ext == ".npz":
+        np.savez_compressed(f, mask=mask)
+    elif ext == ".rle":
+        values, lengths = encode_runs(mask)
+        data = {"shape": list(mask.shape), "values": values.tolist(), "lengths": lengths.tolist()}
+        f.write(json.dumps(data).encode("utf-8"))
+    elif ext == ".json":
+        f.write(json.dumps(to_coco(mask)).encode("utf-8"))
+    else:
+        np.save(f, mask)
+
+
+def save_mask(mask, path, png_path=None):
+    """
+    Write a label map in the format given by the extension of path (see
+    MASK_FORMATS) plus, if png_path is given, its colour PNG preview.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    write_atomic(path, lambda f: _write_labels(f, mask, ext))
+    if png_path:
+        write_atomic(png_path, lambda f: mask_preview(mask).save(f, format="PNG"))
+
+
+def mask_paths(image_path, fmt="npy"):
+    """The (label map, .png preview) paths a mask for image_path is saved to in format fmt."""
+    base = os.path.splitext(image_path)[0] + MASK_SUFFIX
+    return base + MASK_FORMATS[fmt], base + ".png"
+
+
+def mask_candidates(image_path):
+    """Every path a mask for image_path may have been saved to."""
+    base = os.path.splitext(image_path)[0] + MASK_SUFFIX
+    return tuple(base + ext for ext in MASK_EXTENSIONS)
+
+
+def find_mask(image_path):
+    """
+    The mask file saved for image_path: the most recently written label map
+    in any format, else the colour PNG. None if there is none.
+    """
+    newest, newest_mtime = None, None
+    for path in mask_candidates(image_path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        if path.endswith(".png"):
+            return newest or path
+        if newest is None or mtime > newest_mtime:
+            newest, newest_mtime = path, mtime
+    return newest
+
+
+def read_labels(path):
+    """
+    Read a label map saved in any of MASK_FORMATS or as a colour PNG.
+    Large .npy files are memory-mapped copy-on-write: pages are only read
+    when shown or painted, and edits never reach the file until it is
+    saved again. (Not on Windows, which cannot replace a file that is
+    mapped, and saving replaces it.)
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".png":
+        with Image.open(path) as image:
+            return image_to_labels(image)
+    if ext == ".rle":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return decode_runs(data["values"], data["lengths"], tuple(data["shape"]))
+    if ext == ".json":
+        with open(path, encoding="utf-8") as f:
+            return from_coco(json.load(f))
+
+    if ext == ".npz":
+        with np.load(path) as data:
+            labels = data["mask"]
+    else:
+        mmap = os.name != "nt" and os.path.getsize(path) > MASK_MMAP_BYTES
+        labels = np.load(path, mmap_mode="c" if mmap else None)
+    if labels.dtype != MASK_DTYPE:
+        if labels.size and (labels.min() < 0 or labels.max() > np.iinfo(MASK_DTYPE).max):
+            raise ValueError(f"{path} has class numbers outside the {np.dtype(MASK_DTYPE)} range")
+        labels = labels.astype(MASK_DTYPE)
+    return labels
+
+
+def load_labels(image_path):
+    """The label map saved earlier for image_path (see find_mask), or None."""
+    path = find_mask(image_path)
+    return None if path is None else read_labels(path)
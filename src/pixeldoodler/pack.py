@@ -0,0 +1,219 @@
+"""
+Pre-decoded packs of a folder's images, so reopening them skips decoding.
+
+`pixeldoodler-batch pack FOLDER` decodes every image the way the Doodler
+shows it (RGBA, with the default contrast) on a pool of worker processes,
+along with its downsampled pyramid levels, and writes them all into one
+file in the folder's sidecar directory. A JSON index gives the offset and
+sizes of each file's levels, and the size and mtime the file had when it
+was packed. The Doodler memory-maps the pack and wraps images around it
+without copying, so opening a packed file is a page-cache lookup.
+
+Files changed since they were packed are decoded as usual until the folder
+is packed again; packing again only decodes those, and copies the rest
+from the previous pack. Stacks and gigapixel images are not packed.
+"""
+import json
+import os
+import uuid
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from .index import IMAGE_EXTENSIONS
+from .loaders import SIDECAR_DIR, is_stack, read_image, sidecar_path
+from .masks import MASK_SUFFIX, write_atomic
+from .tiled import open_tiled
+
+PACK_INDEX = "pack.json"
+PACK_VERSION = 1
+# Pyramid levels are packed down to this size, like the Doodler's PYRAMID_MIN_SIZE
+PACK_PYRAMID_MIN_SIZE = 256
+# Each file's levels start on a page boundary
+PACK_ALIGN = 4096
+# Bytes copied at a time from the previous pack
+COPY_BLOCK = 16 * 1024 * 1024
+
+
+def _level_sizes(width, height):
+    """(width, height) of every pyramid level, as Image.reduce(2) makes them."""
+    sizes = [(width, height)]
+    while min(sizes[-1]) >= 2 * PACK_PYRAMID_MIN_SIZE:
+        width, height = (width + 1) // 2, (height + 1) // 2
+        sizes.append((width, height))
+    return sizes
+
+
+def _image_size(path):
+    """Displayed (width, height) of a file, read from its header, or None if it is not packed."""
+    if open_tiled(path) is not None:
+        return None
+    if path.lower().endswith(".npy"):
+        array = np.load(path, mmap_mode="r")
+        shape = array.shape
+        if len(shape) < 2 or is_stack(array):
+            return None
+        if len(shape) == 3 and shape[0] in (1, 3, 4) and shape[2] not in (1, 3, 4):
+            return shape[2], shape[1]
+        return shape[1], shape[0]
+    with Image.open(path) as image:
+        return image.size
+
+
+def read_pack_index(folder):
+    """The folder's pack index, or None if it has not been packed."""
+    try:
+        with open(os.path.join(folder, SIDECAR_DIR, PACK_INDEX), encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(index, dict) or index.get("version") != PACK_VERSION:
+        return None
+    return index
+
+
+def _pack_one(task):
+    """
+    Write one file's levels into the new pack. Runs in a worker process and
+    never raises: returns (path, status, detail) with status "packed",
+    "reused" or "failed".
+    """
+    path, data_path, offset, sizes, reuse = task
+    try:
+        with open(data_path, "r+b") as out:
+            out.seek(offset)
+            if reuse is not None:
+                old_path, old_offset = reuse
+                remaining = sum(w * h * 4 for w, h in sizes)
+                with open(old_path, "rb") as old:
+                    old.seek(old_offset)
+                    while remaining:
+                        block = old.read(min(COPY_BLOCK, remaining))
+                        if not block:
+                            raise ValueError("the previous pack is truncated")
+                        out.write(block)
+                        remaining -= len(block)
+                return path, "reused", ""
+
+            image = read_image(path)
+            for level, size in enumerate(sizes):
+                if level:
+                    image = image.reduce(2)
+                if image.size != tuple(size):
+                    raise ValueError(f"decoded size {image.size} does not match its header {tuple(size)}")
+                out.write(image.tobytes())
+    except Exception as e:
+        return path, "failed", str(e)
+    return path, "packed", ""
+
+
+def pack_folder(folder, workers=None):
+    """
+    Pack the images of a folder on a pool of worker processes, yielding
+    (path, status, detail) as files finish (not in folder order), with
+    status "packed", "reused", "skipped" or "failed". The new pack replaces
+    the old one once every file is done.
+    """
+    old = read_pack_index(folder)
+    old_files = old["files"] if old else {}
+    old_data = os.path.join(folder, SIDECAR_DIR, old["data"]) if old else None
+    if old_data is not None and not os.path.exists(old_data):
+        old_files = {}
+
+    data_name = f"pack-{uuid.uuid4().hex[:12]}.bin"
+    data_path = sidecar_path(folder, data_name)
+    files, tasks = {}, []
+    end = 0
+    with os.scandir(folder) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            base, ext = os.path.splitext(entry.name)
+            if ext.lower() not in IMAGE_EXTENSIONS or base.endswith(MASK_SUFFIX) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            previous = old_files.get(entry.name)
+            if previous is not None and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+                sizes = [tuple(size) for size in previous[3]]
+                reuse = (old_data, previous[2])
+            else:
+                try:
+                    size = _image_size(entry.path)
+                except Exception as e:
+                    yield entry.path, "failed", str(e)
+                    continue
+                if size is None:
+                    yield entry.path, "skipped", "stacks and gigapixel images are not packed"
+                    continue
+                sizes, reuse = _level_sizes(*size), None
+            offset = -(-end // PACK_ALIGN) * PACK_ALIGN
+            end = offset + sum(w * h * 4 for w, h in sizes)
+            files[entry.name] = [stat.st_size, stat.st_mtime_ns, offset, [list(s) for s in sizes]]
+            tasks.append((entry.path, data_path, offset, sizes, reuse))
+
+    with open(data_path, "wb") as f:
+        f.truncate(end)
+    try:
+        if tasks:
+            with Pool(workers) as pool:
+                for path, status, detail in pool.imap_unordered(_pack_one, tasks, chunksize=4):
+                    if status == "failed":
+                        files.pop(os.path.basename(path), None)
+                    yield path, status, detail
+        index = {"version": PACK_VERSION, "data": data_name, "files": files}
+        write_atomic(
+            sidecar_path(folder, PACK_INDEX), lambda f: f.write(json.dumps(index).encode("utf-8"))
+        )
+    except BaseException:
+        os.remove(data_path)
+        raise
+
+    # Packs the index no longer points to (open ones stay readable until unmapped)
+    for name in os.listdir(os.path.join(folder, SIDECAR_DIR)):
+        if name.startswith("pack-") and name.endswith(".bin") and name != data_name:
+            try:
+                os.remove(os.path.join(folder, SIDECAR_DIR, name))
+            except OSError:
+                pass  # still mapped on Windows; removed by the next pack
+
+
+class Pack:
+    """A folder's pack, memory-mapped. Reading from it is thread-safe."""
+
+    def __init__(self, folder, index):
+        self.folder = os.path.abspath(folder)
+        self.files = index["files"]
+        path = os.path.join(folder, SIDECAR_DIR, index["data"])
+        self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else None
+
+    def levels(self, image_path):
+        """
+        The packed pyramid of a file as read-only RGBA images sharing the
+        pack's memory (level 0 first), or None if it is not packed or has
+        changed since.
+        """
+        folder, name = os.path.split(os.path.abspath(image_path))
+        entry = self.files.get(name)
+        if entry is None or self.data is None or folder != self.folder:
+            return None
+        size, mtime_ns, offset, sizes = entry
+        stat = os.stat(image_path)
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            return None
+        levels = []
+        for width, height in sizes:
+            nbytes = width * height * 4
+            buffer = self.data[offset:offset + nbytes]
+            levels.append(Image.frombuffer("RGBA", (width, height), buffer, "raw", "RGBA", 0, 1))
+            offset += nbytes
+        return levels
+
+
+def open_pack(folder):
+    """The folder's Pack, or None if it has not been packed (or the pack is unreadable)."""
+    index = read_pack_index(folder)
+    if index is None:
+        return None
+    try:
+        return Pack(folder, index)
+    except (OSError, ValueError, KeyError):
+        return None
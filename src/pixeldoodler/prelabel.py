@@ -0,0 +1,101 @@
+"""
+Model-assisted pre-labelling: a plugin proposes a label map for each file,
+which the Doodler opens as an editable starting mask.
+
+A plugin is any Python callable taking the image as a NumPy array (as
+stored: (H, W), (H, W, C), or the whole array of a multi-plane .npy) and
+returning an integer label map of class numbers shaped like its pixels:
+(H, W), or (planes..., H, W) for a stack. It is named "module:function" or
+"path/to/file.py:function", by `pixeldoodler --prelabel` or the
+PIXELDOODLER_PRELABEL environment variable.
+
+Plugins run in worker processes on the files after the current one, and
+their results are cached in the folder's sidecar directory, keyed by a hash
+of the file and the plugin name (and the function's `version` attribute, if
+it has one, so a new model does not reuse stale results).
+"""
+import importlib
+import importlib.util
+import os
+import re
+
+import numpy as np
+from PIL import Image
+
+from .loaders import file_digest, sidecar_path
+from .masks import MASK_DTYPE, NUMBER_TO_COLOUR, find_mask, write_atomic
+from .tiled import open_tiled
+
+# Environment variable naming the plugin
+PRELABEL_ENV = "PIXELDOODLER_PRELABEL"
+
+# Plugins loaded in this process, by name
+_plugins = {}
+
+
+def load_plugin(spec):
+    """The callable named by spec ("module:function" or "file.py:function")."""
+    if spec not in _plugins:
+        module_name, sep, function_name = spec.rpartition(":")
+        if not sep or not module_name or not function_name:
+            raise ValueError(f"pre-label plugin {spec!r} is not of the form module:function")
+        if module_name.endswith(".py"):
+            module_spec = importlib.util.spec_from_file_location(
+                "_pixeldoodler_prelabel", os.path.abspath(module_name)
+            )
+            module = importlib.util.module_from_spec(module_spec)
+            module_spec.loader.exec_module(module)
+        else:
+            module = importlib.import_module(module_name)
+        _plugins[spec] = getattr(module, function_name)
+    return _plugins[spec]
+
+
+def _cache_path(spec, image_path):
+    version = getattr(load_plugin(spec), "version", "")
+    tag = re.sub(r"[^A-Za-z0-9_.-]+", "-", f"{spec}-{version}" if version else spec)
+    folder = os.path.dirname(os.path.abspath(image_path))
+    return sidecar_path(folder, "prelabels", f"{file_digest(image_path)}_{tag}.npy")
+
+
+def _read_array(image_path):
+    if image_path.lower().endswith(".npy"):
+        return np.load(image_path, mmap_mode="r")
+    with Image.open(image_path) as image:
+        return np.asarray(image)
+
+
+def _check_labels(labels):
+    """The plugin's result as MASK_DTYPE, with numbers that are not classes set to background."""
+    labels = np.asarray(labels)
+    if labels.ndim < 2 or not (np.issubdtype(labels.dtype, np.integer) or labels.dtype == bool):
+        raise ValueError(
+            f"pre-label plugin returned a {labels.dtype} array of shape {labels.shape}, not a label map"
+        )
+    largest = np.iinfo(MASK_DTYPE).max
+    if labels.dtype != bool and (labels.min() < 0 or labels.max() > largest):
+        labels = np.where((labels >= 0) & (labels <= largest), labels, 0)
+    labels = labels.astype(MASK_DTYPE, copy=False)
+    known = np.zeros(largest + 1, dtype=bool)
+    known[list(NUMBER_TO_COLOUR)] = True
+    return np.where(known[labels], labels, 0).astype(MASK_DTYPE, copy=False)
+
+
+def prelabel_file(spec, image_path):
+    """
+    Run the plugin on a file unless it already has a saved mask or a cached
+    result. Runs in a worker process. Returns the path of the cached label
+    map, or None for files that are not pre-labelled (those with a mask,
+    and gigapixel images).
+    """
+    if find_mask(image_path) is not None:
+        return None
+    cache_path = _cache_path(spec, image_path)
+    if os.path.exists(cache_path):
+        return cache_path
+    if open_tiled(image_path) is not None:
+        return None
+    array = _read_array(image_path)
+    labels = _check_labels(load_plugin(spec)(array))
+    write_atomic(cache_path, lambda f: np.save(f, labels))
+    return cache_path
@@ -0,0 +1,176 @@
+import os
+
+import numpy as np
+
+from .loaders import file_digest, sidecar_path
+from .masks import write_atomic
+
+try:
+    from skimage.segmentation import slic
+    HAS_SKIMAGE = True
+except ImportError:
+    HAS_SKIMAGE = False
+
+# Superpixels are seeded on a grid with this spacing in pixels
+SEGMENT_SPACING = 24
+# Weight of spatial distance against colour distance (as in SLIC)
+COMPACTNESS = 10.0
+# Assignment/update rounds of the NumPy fallback
+SLIC_ITERATIONS = 5
+
+
+def _relabel(labels):
+    """Renumber labels to 0..n-1 without gaps, as int32."""
+    present = np.bincount(labels.ravel()) > 0
+    lut = np.cumsum(present, dtype=np.int32) - 1
+    return lut[labels]
+
+
+def _slic_numpy(features, spacing, compactness, iterations=SLIC_ITERATIONS):
+    """
+    Plain NumPy SLIC: k-means over colour and position where every pixel
+    only competes between the 3x3 grid cells around its own. Segments are
+    not forced to be connected.
+    """
+    channels, height, width = features.shape
+    ny, nx = max(1, height // spacing), max(1, width // spacing)
+    cell_y = np.minimum(np.arange(height) * ny // height, ny - 1)
+    cell_x = np.minimum(np.arange(width) * nx // width, nx - 1)
+
+    centre_y = ((np.arange(ny) + 0.5) * height / ny)[:, None].repeat(nx, 1).ravel()
+    centre_x = ((np.arange(nx) + 0.5) * width / nx)[None, :].repeat(ny, 0).ravel()
+    centre_f = features[:, centre_y.astype(int), centre_x.astype(int)].astype(np.float64)
+    spatial_weight = (compactness / spacing) ** 2
+
+    labels = np.empty((height, width), dtype=np.int32)
+    xs = np.arange(width, dtype=np.float32)
+    ys_all = np.arange(height, dtype=np.float32)[:, None]
+    # Pixel rows of each band of grid cells; within a band, the candidate
+    # centres only depend on the column, so they are gathered once per column
+    band_edges = np.searchsorted(cell_y, np.arange(ny + 1))
+    for _ in range(iterations):
+        cy, cx, cf = (a.astype(np.float32) for a in (centre_y, centre_x, centre_f))
+        for band in range(ny):
+            top, bottom = band_edges[band], band_edges[band + 1]
+            block = features[:, top:bottom]
+            ys = ys_all[top:bottom]
+            dists = np.empty((9, bottom - top, width), dtype=np.float32)
+            candidates = np.empty((9, width), dtype=np.int64)
+            for k, (dy, dx) in enumerate((dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)):
+                row = min(max(band + dy, 0), ny - 1) * nx
+                candidate = candidates[k] = row + np.clip(cell_x + dx, 0, nx - 1)
+                dist = dists[k]
+                np.square(ys - cy[candidate], out=dist)
+                dist += (xs - cx[candidate]) ** 2
+                dist *= spatial_weight
+                for channel in range(channels):
+                    dist += (block[channel] - cf[channel, candidate]) ** 2
+            nearest = dists.argmin(axis=0)
+            labels[top:bottom] = candidates[nearest, np.arange(width)]
+
+        # Move every centre to the mean colour and position of its pixels
+        counts = np.bincount(labels.ravel(), minlength=ny * nx)
+        used = counts > 0
+        row_sums = np.bincount(labels.ravel(), np.broadcast_to(ys_all, labels.shape).ravel(), ny * nx)
+        col_sums = np.bincount(labels.ravel(), np.broadcast_to(xs, labels.shape).ravel(), ny * nx)
+        centre_y[used] = row_sums[used] / counts[used]
+        centre_x[used] = col_sums[used] / counts[used]
+        for channel in range(channels):
+            sums = np.bincount(labels.ravel(), features[channel].ravel(), ny * nx)
+            centre_f[channel, used] = sums[used] / counts[used]
+    return labels
+
+
+def compute_superpixels(image, spacing=SEGMENT_SPACING, compactness=COMPACTNESS):
+    """
+    Over-segment a Pillow image into superpixels of roughly spacing x
+    spacing pixels. Uses scikit-image's SLIC when it is installed, else a
+    NumPy implementation of the same idea. Returns an int32 label map with
+    ids 0..n-1.
+    """
+    rgb = np.asarray(image.convert("RGB"))
+    if HAS_SKIMAGE:
+        n_segments = max(1, rgb.shape[0] * rgb.shape[1] // (spacing * spacing))
+        labels = slic(rgb, n_segments=n_segments, compactness=compactness, start_label=0)
+    else:
+        # Gray images only need one channel
+        if (rgb[..., 0] == rgb[..., 1]).all() and (rgb[..., 1] == rgb[..., 2]).all():
+            rgb = rgb[..., :1]
+        # One plane per channel, scaled to roughly the 0-100 range of
+        # CIELAB lightness that SLIC's compactness is tuned for
+        features = np.moveaxis(rgb, -1, 0).astype(np.float32) * (100.0 / 255.0)
+        labels = _slic_numpy(features, spacing, compactness)
+    return _relabel(labels)
+
+
+class Superpixels:
+    """
+    A superpixel label map with an index from segment id to its pixels, so
+    a set of whole segments can be labelled with one vectorised assignment
+    that only touches their pixels.
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        height, width = labels.shape
+        flat = labels.ravel()
+        self.count = int(flat.max()) + 1
+        # Pixels in segment i are order[offsets[i]:offsets[i + 1]] (flat indices)
+        self.order = np.argsort(flat, kind="stable")
+        self.offsets = np.zeros(self.count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(flat, minlength=self.count), out=self.offsets[1:])
+        ys, xs = np.divmod(self.order, width)
+        starts = self.offsets[:-1]
+        self.boxes = np.stack([
+            np.minimum.reduceat(xs, starts),
+            np.minimum.reduceat(ys, starts),
+            np.maximum.reduceat(xs, starts) + 1,
+            np.maximum.reduceat(ys, starts) + 1,
+        ], axis=1)
+
+    def segments_in(self, left, top, right, bottom, footprint=None):
+        """Ids of the segments under a box, or under the True pixels of a footprint covering it."""
+        patch = self.labels[top:bottom, left:right]
+        return np.unique(patch if footprint is None else patch[footprint])
+
+    def pixels(self, ids):
+        """Flat indices of all pixels in the given segments."""
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in ids])
+
+    def box(self, ids):
+        """Bounding box (x1, y1, x2, y2) of the given segments."""
+        boxes = self.boxes[ids]
+        return (
+            int(boxes[:, 0].min()), int(boxes[:, 1].min()),
+            int(boxes[:, 2].max()), int(boxes[:, 3].max()),
+        )
+
+
+def load_superpixels(image_path, image, variant=""):
+    """
+    Superpixels for a file, read from the folder's sidecar cache when they
+    were computed before. The cache is keyed by a hash of the file's bytes
+    (plus variant, e.g. the plane of a stack), so renamed or copied files
+    hit it too. A folder that cannot be written to just goes uncached.
+    """
+    name = f"{file_digest(image_path)}{variant}_{SEGMENT_SPACING}_{COMPACTNESS:g}.npy"
+    folder = os.path.dirname(os.path.abspath(image_path))
+    try:
+        cache_path = sidecar_path(folder, "superpixels", name)
+    except OSError:
+        cache_path = None
+
+    labels = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            labels = np.load(cache_path)
+        except (OSError, ValueError):
+            labels = None
+    if labels is None or labels.shape != (image.height, image.width):
+        labels = compute_superpixels(image)
+        if cache_path:
+            try:
+                write_atomic(cache_path, lambda f: np.save(f, labels))
+            except OSError:
+                pass
+    return Superpixels(labels)
@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+from .loaders import NpyStack, is_stack, npy_to_image, read_image, sidecar_path
+from .masks import OVERLAY_LUT, load_labels, mask_candidates, write_atomic
+from .tiled import open_tiled
+
+# Thumbnails fit in a square of this many pixels
+THUMB_SIZE = 96
+
+
+def thumbnail_key(image_path):
+    """
+    Content address of an image's thumbnail: the file's path, mtime and
+    size, and those of its saved mask, so editing either gives a new key.
+    """
+    parts = [os.path.abspath(image_path), THUMB_SIZE]
+    for path in (image_path,) + mask_candidates(image_path):
+        try:
+            stat = os.stat(path)
+            parts += [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            parts.append(None)
+    return hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _subsample(arr, size):
+    """
+    Every n-th pixel of an image array, keeping its longer side at least
+    size pixels. Memory-mapped arrays only have those pixels read.
+    """
+    channels_first = arr.ndim == 3 and arr.shape[0] in (1, 3, 4) and arr.shape[2] not in (1, 3, 4)
+    rows, cols = arr.shape[1:3] if channels_first else arr.shape[:2]
+    step = max(1, max(rows, cols) // size)
+    return arr[:, ::step, ::step] if channels_first else arr[::step, ::step]
+
+
+def make_thumbnail(image_path, size=THUMB_SIZE):
+    """
+    Small RGBA preview of an image file with its saved mask (if any) drawn
+    over it. Large files are never decoded at full resolution: .npy arrays
+    are subsampled through a memory map, tiled TIFFs are read from their
+    smallest pyramid level and JPEGs are decoded in draft mode.
+    """
+    tiled = open_tiled(image_path)
+    if tiled is not None:
+        image = tiled.overview(size)
+    elif image_path.lower().endswith(".npy"):
+        arr = np.load(image_path, mmap_mode="r")
+        if is_stack(arr):
+            arr = NpyStack(arr).planes[0]
+        image = npy_to_image(_subsample(arr, size))
+    else:
+        image = read_image(image_path, draft_size=(size, size))
+    image.thumbnail((size, size))
+
+    labels = load_labels(image_path)
+    if labels is not None:
+        if labels.ndim > 2:
+            labels = labels.reshape((-1,) + labels.shape[-2:])[0]
+        overlay = Image.fromarray(OVERLAY_LUT[_subsample(labels, size)])
+        image = Image.alpha_composite(image, overlay.resize(image.size, Image.Resampling.NEAREST))
+    return image
+
+
+def load_thumbnail(image_path):
+    """
+    Thumbnail of an image file from the folder's on-disk cache
+    (<folder>/.pixeldoodler/thumbs), making and storing it on a miss.
+    Safe to call from worker threads.
+    """
+    key = thumbnail_key(image_path)
+    folder = os.path.dirname(os.path.abspath(image_path))
+    try:
+        cache_path = sidecar_path(folder, "thumbs", key[:2], key + ".png")
+    except OSError:
+        cache_path = None
+
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with Image.open(cache_path) as cached:
+                return cached.convert("RGBA")
+        except OSError:
+            pass
+
+    image = make_thumbnail(image_path)
+    if cache_path:
+        try:
+            write_atomic(cache_path, lambda f: image.convert("RGB").save(f, format="PNG"))
+        except OSError:
+            pass
+    return image
@@ -0,0 +1,268 @@
+"""
+Chunked stand-ins for the display image and the label map, for whole-slide
+and other gigapixel images that do not fit in memory at full resolution.
+Memory use grows with what is on screen and what has been painted, not with
+the size of the image.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+from .loaders import cached_value_range, file_key, is_stack, to_uint8
+from .masks import MASK_DTYPE
+
+try:
+    import tifffile
+    import zarr
+    HAS_TIFFFILE = True
+except ImportError:
+    HAS_TIFFFILE = False
+
+# Images with more pixels than this are opened tiled instead of decoded whole
+TILED_MIN_PIXELS = 64 * 1024 * 1024
+# Side length of the chunks a TiledMask allocates when painted
+MASK_CHUNK = 256
+# Stop adding pyramid levels once a level gets this small
+TILED_PYRAMID_MIN_SIZE = 256
+
+
+class TiledImage:
+    """
+    Read-only stand-in for a Pillow RGBA image whose pixels stay on disk
+    (a memory-mapped array or a tiled TIFF). Provides what the tile renderer
+    uses: size, width, height and crop(), which only reads and converts the
+    pixels inside the box. levels holds the same image at halved
+    resolutions, from the file's own pyramid or by striding the array.
+    """
+
+    mode = "RGBA"
+
+    def __init__(self, array, value_range, levels=()):
+        self.array = array
+        self.value_range = value_range
+        self.height, self.width = array.shape[:2]
+        self.levels = [self] + [TiledImage(level, value_range) for level in levels]
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def crop(self, box):
+        left, top, right, bottom = (int(v) for v in box)
+        left, top = max(0, left), max(0, top)
+        right, bottom = min(self.width, right), min(self.height, bottom)
+        return self._to_image(self.array[top:max(top, bottom), left:max(left, right)])
+
+    def overview(self, size):
+        """The whole image, subsampled so its longer side is at least size pixels."""
+        level = next((level for level in reversed(self.levels) if max(level.size) >= size), self)
+        step = max(1, max(level.size) // size)
+        return self._to_image(level.array[::step, ::step])
+
+    def _to_image(self, block):
+        block = np.asarray(block)
+        if block.dtype != np.uint8 or block.ndim == 2:
+            block = to_uint8(block, *self.value_range)
+        img = Image.fromarray(np.ascontiguousarray(block))
+        return img if img.mode == "RGBA" else img.convert("RGBA")
+
+
+def _strided_levels(array):
+    levels, step = [], 2
+    while min(array.shape[0], array.shape[1]) // step >= TILED_PYRAMID_MIN_SIZE:
+        levels.append(array[::step, ::step])
+        step *= 2
+    return levels
+
+
+def _open_array(array, key, percentiles):
+    """A TiledImage over an (H, W) or (H, W, C) array and its pyramid levels."""
+    levels = _strided_levels(array)
+    # Display range from the smallest level: a subsample of the whole image
+    smallest = levels[-1] if levels else array
+    value_range = (0, 255)
+    if array.dtype != np.uint8 or array.ndim == 2:
+        value_range = cached_value_range(key + ("overview",), np.asarray(smallest), percentiles)
+    return TiledImage(array, value_range, levels)
+
+
+def _open_tiff(image_path, key, percentiles):
+    """TiledImage over a (pyramidal) tiled TIFF, read tile by tile through zarr."""
+    store = tifffile.imread(image_path, aszarr=True)
+    opened = zarr.open(store, mode="r")
+    if isinstance(opened, zarr.Array):
+        levels = [opened]
+    else:
+        levels = [opened[name] for name in sorted(opened.array_keys(), key=int)]
+    full = levels[0]
+    if full.ndim == 3 and full.shape[0] in (3, 4) and full.shape[2] not in (3, 4):
+        return None  # planar (C, H, W) layouts are not supported tiled
+    if full.shape[0] * full.shape[1] < TILED_MIN_PIXELS:
+        return None
+    smallest = np.asarray(levels[-1][:])
+    value_range = (0, 255)
+    if full.dtype != np.uint8 or full.ndim == 2:
+        value_range = cached_value_range(key + ("overview",), smallest, percentiles)
+    return TiledImage(full, value_range, levels[1:])
+
+
+def open_tiled(image_path, percentiles=None):
+    """
+    Open an image as a TiledImage if it is big enough to need it and stored
+    so that parts can be read on their own: a 2D or channels-last .npy
+    array (memory-mapped), or a tiled TIFF (needs tifffile and zarr).
+    Returns None otherwise, for the usual whole-image path.
+    """
+    ext = os.path.splitext(image_path)[1].lower()
+    if ext == ".npy":
+        array = np.load(image_path, mmap_mode="r")
+        if is_stack(array) or array.ndim not in (2, 3):
+            return None
+        if array.ndim == 3 and array.shape[0] in (1, 3, 4) and array.shape[2] not in (1, 3, 4):
+            array = array.transpose(1, 2, 0)
+        if array.ndim == 3 and array.shape[2] == 1:
+            array = array[:, :, 0]
+        if array.shape[0] * array.shape[1] < TILED_MIN_PIXELS:
+            return None
+        return _open_array(array, file_key(image_path), percentiles)
+    if ext in (".tif", ".tiff") and HAS_TIFFFILE:
+        with tifffile.TiffFile(image_path) as tif:
+            page = tif.pages[0]
+            if not page.is_tiled or page.shape[0] * page.shape[1] < TILED_MIN_PIXELS:
+                return None
+        return _open_tiff(image_path, file_key(image_path), percentiles)
+    return None
+
+
+class TiledMask:
+    """
+    Label map split into MASK_CHUNK x MASK_CHUNK chunks that are only
+    allocated once painted; everything else reads as the base array (a
+    previously saved mask, typically memory-mapped) or as background.
+
+    Supports the parts of the ndarray interface the editor uses: shape,
+    dtype, reading and writing 2D slices (reads return copies), plus
+    sample() for the zoomed display and write_npy() for saving.
+    """
+
+    ndim = 2
+
+    def __init__(self, shape, dtype=MASK_DTYPE, base=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.base = base
+        self.chunks = {}  # (cy, cx) -> array
+
+    @property
+    def nbytes(self):
+        """Memory held by painted chunks."""
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    def copy(self):
+        """Snapshot for saving: copies the painted chunks, shares the (read-only) base."""
+        other = TiledMask(self.shape, self.dtype, self.base)
+        other.chunks = {key: chunk.copy() for key, chunk in self.chunks.items()}
+        return other
+
+    def clear(self):
+        self.chunks = {}
+        self.base = None
+
+    def _box(self, key):
+        rows, cols = key
+        height, width = self.shape
+        top, bottom, _ = rows.indices(height)
+        left, right, _ = cols.indices(width)
+        if rows.step not in (None, 1) or cols.step not in (None, 1):
+            raise IndexError("TiledMask only supports contiguous slices")
+        return left, top, max(left, right), max(top, bottom)
+
+    def _chunks_in(self, left, top, right, bottom):
+        """(cy, cx, chunk box) for every chunk position overlapping the box."""
+        height, width = self.shape
+        for cy in range(top // MASK_CHUNK, (bottom - 1) // MASK_CHUNK + 1):
+            for cx in range(left // MASK_CHUNK, (right - 1) // MASK_CHUNK + 1):
+                x1, y1 = cx * MASK_CHUNK, cy * MASK_CHUNK
+                yield cy, cx, (x1, y1, min(width, x1 + MASK_CHUNK), min(height, y1 + MASK_CHUNK))
+
+    def __getitem__(self, key):
+        left, top, right, bottom = self._box(key)
+        if self.base is not None:
+            out = np.array(self.base[top:bottom, left:right], dtype=self.dtype)
+        else:
+            out = np.zeros((bottom - top, right - left), dtype=self.dtype)
+        if right > left and bottom > top:
+            for cy, cx, (x1, y1, x2, y2) in self._chunks_in(left, top, right, bottom):
+                chunk = self.chunks.get((cy, cx))
+                if chunk is None:
+                    continue
+                ox1, oy1 = max(x1, left), max(y1, top)
+                ox2, oy2 = min(x2, right), min(y2, bottom)
+                out[oy1 - top:oy2 - top, ox1 - left:ox2 - left] = chunk[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1]
+        return out
+
+    def __setitem__(self, key, value):
+        left, top, right, bottom = self._box(key)
+        if right <= left or bottom <= top:
+            return
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), (bottom - top, right - left))
+        for cy, cx, (x1, y1, x2, y2) in self._chunks_in(left, top, right, bottom):
+            chunk = self.chunks.get((cy, cx))
+            if chunk is None:
+                if self.base is not None:
+                    chunk = np.array(self.base[y1:y2, x1:x2], dtype=self.dtype)
+                else:
+                    chunk = np.zeros((y2 - y1, x2 - x1), dtype=self.dtype)
+                self.chunks[(cy, cx)] = chunk
+            ox1, oy1 = max(x1, left), max(y1, top)
+            ox2, oy2 = min(x2, right), min(y2, bottom)
+            chunk[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1] = value[oy1 - top:oy2 - top, ox1 - left:ox2 - left]
+
+    def sample(self, rows, cols):
+        """
+        Labels at the crossings of the given (ascending) row and column
+        indices, i.e. mask[np.ix_(rows, cols)], reading only those pixels.
+        """
+        if self.base is not None:
+            out = np.asarray(self.base[rows[:, None], cols], dtype=self.dtype)
+        else:
+            out = np.zeros((len(rows), len(cols)), dtype=self.dtype)
+        if not self.chunks or not len(rows) or not len(cols):
+            return out
+        cy_range = range(rows[0] // MASK_CHUNK, rows[-1] // MASK_CHUNK + 1)
+        cx_range = range(cols[0] // MASK_CHUNK, cols[-1] // MASK_CHUNK + 1)
+        if len(cy_range) * len(cx_range) <= len(self.chunks):
+            keys = [(cy, cx) for cy in cy_range for cx in cx_range if (cy, cx) in self.chunks]
+        else:
+            keys = [
+                (cy, cx) for cy, cx in self.chunks
+                if cy in cy_range and cx in cx_range
+            ]
+        for cy, cx in keys:
+            r0, r1 = np.searchsorted(rows, [cy * MASK_CHUNK, (cy + 1) * MASK_CHUNK])
+            c0, c1 = np.searchsorted(cols, [cx * MASK_CHUNK, (cx + 1) * MASK_CHUNK])
+            if r1 > r0 and c1 > c0:
+                chunk = self.chunks[(cy, cx)]
+                out[r0:r1, c0:c1] = chunk[(rows[r0:r1] - cy * MASK_CHUNK)[:, None], cols[c0:c1] - cx * MASK_CHUNK]
+        return out
+
+    def write_npy(self, f):
+        """
+        Write the label map to an open file in .npy format, one band of
+        chunk rows at a time. Bands with nothing in them are skipped with a
+        seek, which leaves a hole on file systems with sparse files.
+        """
+        height, width = self.shape
+        np.lib.format.write_array_header_1_0(
+            f,
+            {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": self.shape},
+        )
+        painted_rows = {cy for cy, _ in self.chunks}
+        for cy in range((height + MASK_CHUNK - 1) // MASK_CHUNK):
+            top, bottom = cy * MASK_CHUNK, min(height, (cy + 1) * MASK_CHUNK)
+            if self.base is None and cy not in painted_rows:
+                f.seek((bottom - top) * width * self.dtype.itemsize, os.SEEK_CUR)
+                continue
+            f.write(self[top:bottom, 0:width].tobytes())
+        f.truncate()